@@ -0,0 +1,192 @@
+"""
+Animation of the arcs being made, one frame per arc, written straight to a GIF or MP4.
+
+    python main.py --headless --animation output/arcs.gif
+    python main.py --headless --animation output/arcs.mp4 --animation-worker
+
+Frames never go to disk as pictures: every frame is taken from the canvas in memory and handed to
+the imageio encoder (Pillow for GIF, ffmpeg for MP4). The canvas is kept between frames and only
+the newest arc is drawn onto it, so a frame costs the same at the end of a big part as at the start.
+With a worker process, generation only sends the shapes through a queue and carries on while the
+frames are drawn and encoded.
+
+Needs matplotlib and imageio (plus imageio-ffmpeg for MP4), which are only imported when an
+animation is made.
+"""
+import multiprocessing
+
+import numpy as np
+import shapely
+
+import util
+
+class FrameRenderer:
+    """
+    Draws the arcs onto a persistent canvas and streams a frame to the encoder after every one.
+
+    Parameters
+    ----------
+    file_name: str
+        The animation file. The format comes from the extension (.gif, .mp4, ...).
+
+    fps: float
+        Frames per second
+
+    dpi: int
+        Resolution of the frames. With the default figure size, 100 gives 640x480.
+
+    arcs_per_frame: int
+        Only write a frame after this many arcs, for big parts
+    """
+    def __init__(self, file_name, fps=20, dpi=100, arcs_per_frame=1, figsize=(6.4, 4.8)):
+        # Only pay for the plotting and video packages when an animation is made
+        import imageio
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+        self.figure = Figure(figsize=figsize, dpi=dpi)
+        self.canvas = FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        self.ax.set_aspect('equal')
+        self.ax.set_axis_off()
+        self.writer = imageio.get_writer(file_name, mode='I', fps=fps)
+        self.arcs_per_frame = arcs_per_frame
+        self.pending_arcs = 0
+        self.base_polys = []
+        self.starting_lines = []
+        self.started = False
+
+    def add_base_poly(self, poly):
+        self.base_polys.append(poly)
+
+    def add_starting_line(self, line):
+        self.starting_lines.append(line)
+
+    def _start(self):
+        """Fit the view to the base polygons and draw them once. Everything after is drawn on top."""
+        from matplotlib.patches import Polygon as PolygonPatch
+
+        if self.base_polys:
+            min_x, min_y, max_x, max_y = shapely.total_bounds(self.base_polys)
+            margin = 0.05 * max(max_x - min_x, max_y - min_y)
+            self.ax.set_xlim(min_x - margin, max_x + margin)
+            self.ax.set_ylim(min_y - margin, max_y + margin)
+        for poly in self.base_polys:
+            for part in shapely.get_parts(poly):
+                self.ax.add_patch(PolygonPatch(np.asarray(part.exterior.coords), facecolor='white', edgecolor='black', linewidth=1))
+        for line in self.starting_lines:
+            coords = shapely.get_coordinates(line)
+            self.ax.plot(coords[:, 0], coords[:, 1], color='red', linewidth=2)
+        self.canvas.draw()
+        self.started = True
+
+    def _draw(self, artist):
+        """Draw one new artist over what is already on the canvas"""
+        artist.set_animated(True)  # Keeps it out of full redraws, it is already on the canvas
+        self.ax.draw_artist(artist)
+
+    def add_arc(self, arc, depth):
+        from matplotlib.patches import Polygon as PolygonPatch
+
+        if not self.started:
+            self._start()
+        for part in shapely.get_parts(arc):
+            if part.geom_type == 'Polygon':
+                self._draw(self.ax.add_patch(PolygonPatch(np.asarray(part.exterior.coords), facecolor=util.num_to_rgb(depth),
+                                                          edgecolor='black', linewidth=0.5)))
+        self.pending_arcs += 1
+        if self.pending_arcs >= self.arcs_per_frame:
+            self.write_frame()
+
+    def add_ring(self, line):
+        if not self.started:
+            self._start()
+        for part in shapely.get_parts(line):
+            coords = shapely.get_coordinates(part)
+            self._draw(self.ax.plot(coords[:, 0], coords[:, 1], color='blue', linewidth=0.5)[0])
+        self.write_frame()
+
+    def write_frame(self):
+        """Send the canvas as it is now to the encoder"""
+        self.writer.append_data(np.asarray(self.canvas.buffer_rgba())[:, :, :3].copy())
+        self.pending_arcs = 0
+
+    def close(self):
+        """Write the last frame and finish the file"""
+        if self.pending_arcs:
+            self.write_frame()
+        self.writer.close()
+
+def _render_frames(queue, file_name, options):
+    """Worker process: draw everything that comes through the queue until None arrives"""
+    renderer = FrameRenderer(file_name, **options)
+    for method, args in iter(queue.get, None):
+        getattr(renderer, method)(*args)
+    renderer.close()
+
+class AnimatedPreview(util.Preview):
+    """
+    A Preview that also animates the arcs as they are added. Pass it to main.generate like any
+    Preview, and call close() once generation is done to finish the file.
+
+    Parameters
+    ----------
+    file_name: str
+        The animation file (.gif or .mp4)
+
+    worker: bool
+        Draw and encode the frames in a separate process
+
+    options:
+        fps, dpi, arcs_per_frame, figsize, see FrameRenderer
+    """
+    def __init__(self, file_name, worker=False, **options):
+        super().__init__()
+        if worker:
+            self.queue = multiprocessing.Queue()
+            # A daemon, so an exit that skips close() can't be held up waiting for it
+            self.process = multiprocessing.Process(target=_render_frames, args=(self.queue, file_name, options), daemon=True)
+            self.process.start()
+            self.renderer = None
+        else:
+            self.renderer = FrameRenderer(file_name, **options)
+            self.process = None
+
+    def _send(self, method, *args):
+        if self.renderer is not None:
+            getattr(self.renderer, method)(*args)
+        else:
+            self.queue.put((method, args))
+
+    def add_base_poly(self, poly):
+        super().add_base_poly(poly)
+        self._send("add_base_poly", poly)
+
+    def add_starting_line(self, line):
+        super().add_starting_line(line)
+        self._send("add_starting_line", line)
+
+    def add_arc(self, arc, depth):
+        super().add_arc(arc, depth)
+        self._send("add_arc", arc, depth)
+
+    def add_ring(self, line):
+        super().add_ring(line)
+        self._send("add_ring", line)
+
+    def extend(self, other):
+        """Islands filled in worker processes only arrive at the end, and are animated then"""
+        for arc, depth in zip(other.arcs, other.arc_depths):
+            self.add_arc(arc, depth)
+        for line in other.rings:
+            self.add_ring(line)
+        self.base_polys += other.base_polys
+        self.starting_lines += other.starting_lines
+
+    def close(self):
+        """Finish the animation file (waits for the worker process)"""
+        if self.renderer is not None:
+            self.renderer.close()
+        else:
+            self.queue.put(None)
+            self.process.join()
@@ -0,0 +1,120 @@
+"""
+Generate gcode for many independent overhang parts at once, spread over several processes.
+
+Usage:
+    python batch.py jobs.json --output-dir output/batch
+
+jobs.json holds a list of jobs. Every key is optional:
+    [{"params": {"avg_radius": 8, "x_axis": 60}, "seed": 3},
+     {"polygon": [[0, 0], [20, 0], [20, 15], [0, 15]], "params": {"r_max": 6}},
+     {"polygon": [[[0, 0], [20, 0], [20, 15]], [[30, 0], [50, 0], [40, 15]]]}]
+
+A polygon given as a list of coordinate lists is a set of islands.
+"""
+import argparse
+import json
+import os
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from shapely.geometry import Polygon, MultiPolygon
+
+import main
+
+def run_job(job):
+    """
+    Generate the gcode for a single job. Runs in a worker process.
+
+    Parameters
+    ----------
+    job: dict
+        params: settings for main.generate (optional)
+        polygon: Polygon, MultiPolygon, list of (x, y), or list of lists of (x, y) for several islands.
+            A random polygon is generated when left out.
+        seed: seed for the random polygon
+        max_depth, max_arcs: work limits for main.generate (optional)
+        cache_dir: folder of filled islands shared by all jobs, see main.generate (optional)
+
+    Returns
+    -------
+    dict
+        gcode (None if the job failed), seconds taken, the seed used and the error if there was one
+    """
+    start_time = time.perf_counter()
+    try:
+        # A polygon that can't be read only fails this job, not the whole batch
+        polygon = job.get("polygon")
+        if polygon is not None and not isinstance(polygon, (Polygon, MultiPolygon)):
+            if isinstance(polygon[0][0], (list, tuple)):
+                polygon = MultiPolygon([Polygon(island) for island in polygon])
+            else:
+                polygon = Polygon(polygon)
+        gcode = main.generate(job.get("params", {}), max_depth=job.get("max_depth"), max_arcs=job.get("max_arcs"),
+                              base_poly=polygon, seed=job.get("seed"), max_workers=1,
+                              cache_dir=job.get("cache_dir"))
+        error = None
+    except Exception:
+        gcode = None
+        error = traceback.format_exc()
+    return {"gcode": gcode, "seconds": time.perf_counter() - start_time, "seed": job.get("seed"), "error": error}
+
+def generate_batch(jobs, max_workers=None, base_seed=0, cache_dir=None):
+    """
+    Generate gcode for a list of jobs in parallel.
+
+    Parameters
+    ----------
+    jobs: list of dict
+        See run_job
+
+    max_workers: int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+
+    base_seed: int
+        Jobs without a seed get base_seed + their index in the list, so the same
+        list of jobs always gives the same shapes no matter which worker runs them.
+
+    cache_dir: str, optional
+        Share filled islands between the jobs through this folder, so repeated shapes are only filled once
+        (see fill_cache.py). Jobs can still set their own.
+
+    Returns
+    -------
+    list of dict
+        The result of run_job for every job, in the same order as jobs
+    """
+    jobs = [dict(job, seed=job.get("seed", base_seed + i), cache_dir=job.get("cache_dir", cache_dir))
+            for i, job in enumerate(jobs)]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(run_job, jobs))
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Generate arc overhang gcode for many parts in parallel")
+    parser.add_argument("jobs", help="JSON file with a list of jobs")
+    parser.add_argument("--output-dir", default="output/batch", help="Folder for the gcode files")
+    parser.add_argument("--workers", type=int, help="Number of worker processes (default: number of CPUs)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the first job that doesn't set its own")
+    parser.add_argument("--cache-dir", help="Reuse filled islands of the same shape and settings from this folder")
+    args = parser.parse_args(argv)
+
+    with open(args.jobs, 'r') as f:
+        jobs = json.load(f)
+
+    start_time = time.perf_counter()
+    results = generate_batch(jobs, args.workers, args.seed, args.cache_dir)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for i, result in enumerate(results):
+        if result["error"]:
+            print(f"Job {i}: failed after {result['seconds']:.2f} s\n{result['error']}")
+            continue
+        file_name = os.path.join(args.output_dir, f"job_{i:03d}.gcode")
+        with open(file_name, 'w') as gcode_file:
+            gcode_file.write(result["gcode"])
+        print(f"Job {i}: {result['seconds']:.2f} s (seed {result['seed']}) -> {file_name}")
+    print(f"{len(results)} jobs in {time.perf_counter() - start_time:.2f} s")
+    return 1 if any(result["error"] for result in results) else 0
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main_cli())
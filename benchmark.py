@@ -0,0 +1,681 @@
+"""
+Benchmarks for the arc overhang generator.
+
+Usage:
+    python benchmark.py startup     # cold import cost of the gcode generation path
+    python benchmark.py limits      # generation finishes with circles smaller than a line width
+    python benchmark.py farthest    # util.get_farthest_point against the original per-vertex loop
+    python benchmark.py arcs        # util.create_arc against the original list based vertex filter,
+                                    # and util.create_arc_analytic against util.create_arc
+    python benchmark.py empty       # util.FilledShapes against buffering the remaining empty space
+    python benchmark.py simplify    # vertex growth of the empty space with and without --simplify-tolerance
+    python benchmark.py emit        # flow sweep by re-emitting a saved toolpath against filling again
+    python benchmark.py corpus      # full generation over a fixed, seeded set of polygons (speed and output regressions)
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+
+REPO_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# Packages that generating gcode should never need to import
+HEAVY_MODULES = ["geopandas", "matplotlib", "pandas", "tkinter", "imageio", "moviepy"]
+
+STARTUP_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import main
+seconds = time.perf_counter() - start
+heavy_modules = sorted({{name.split('.')[0] for name in sys.modules}} & set({heavy_modules!r}))
+print(json.dumps({{"seconds": seconds, "heavy_modules": heavy_modules}}))
+"""
+
+LIMITS_SCRIPT = """
+import contextlib, io, json, sys, time
+import main
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    gcode = main.generate(json.loads(sys.argv[1]), seed=int(sys.argv[2]), max_workers=1)
+print(json.dumps({"seconds": time.perf_counter() - start, "bytes": len(gcode)}))
+"""
+
+# Settings at the edges of what generation has to cope with: circles smaller than a line width
+LIMITS_CASES = [{"r_min": 0.3}, {"r_min": 0.2, "r_max": 0.3}, {"r_min": 0.1, "r_max": 2}]
+
+def bench_limits(seeds=(1, 2, 3, 4), timeout=60):
+    """
+    Generate parts with the LIMITS_CASES settings, each in a fresh interpreter that gets killed
+    after timeout seconds, so a generation that never finishes shows up as a failure instead of a hang.
+
+    Returns
+    -------
+    list of dict
+        params, seed, and seconds taken (None if it timed out) plus the error if it failed
+    """
+    results = []
+    for params in LIMITS_CASES:
+        for seed in seeds:
+            result = {"params": params, "seed": seed, "seconds": None, "error": None}
+            try:
+                run = subprocess.run([sys.executable, "-c", LIMITS_SCRIPT, json.dumps(params), str(seed)],
+                                     cwd=REPO_DIRECTORY, capture_output=True, text=True, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                result["error"] = f"still running after {timeout} s"
+            else:
+                if run.returncode == 0:
+                    result["seconds"] = json.loads(run.stdout)["seconds"]
+                else:
+                    result["error"] = run.stderr.strip().splitlines()[-1]
+            results.append(result)
+    return results
+
+def bench_startup(repeat=5):
+    """
+    Import main in a fresh interpreter a few times and time it.
+
+    Parameters
+    ----------
+    repeat: int
+        How many fresh interpreters to start
+
+    Returns
+    -------
+    dict
+        Median and minimum import time in seconds, and any heavy packages that got imported
+    """
+    script = STARTUP_SCRIPT.format(heavy_modules=HEAVY_MODULES)
+    runs = []
+    for _ in range(repeat):
+        result = subprocess.run([sys.executable, "-c", script], cwd=REPO_DIRECTORY,
+                                capture_output=True, text=True, check=True)
+        runs.append(json.loads(result.stdout))
+
+    seconds = [run["seconds"] for run in runs]
+    return {"median_seconds": statistics.median(seconds),
+            "min_seconds": min(seconds),
+            "heavy_modules": sorted({name for run in runs for name in run["heavy_modules"]})}
+
+def _test_polygon(seed, avg_radius, num_vertices):
+    """A random polygon that only depends on seed, for the benchmarks to work on"""
+    from shapely.geometry import Polygon
+    import util
+
+    return Polygon(util.generate_polygon(center=(100, 50), avg_radius=avg_radius, irregularity=0.5, spikiness=0.3,
+                                         num_vertices=num_vertices, rng=random.Random(seed)))
+
+def get_farthest_point_reference(arc, base_poly, remaining_empty_space):
+    """The original per-vertex implementation of util.get_farthest_point, kept to compare against"""
+    from shapely.geometry import Point
+    from shapely.ops import nearest_points
+    import numpy as np
+
+    longest_distance = 0
+    farthest_point = Point([0, 0])
+    if arc.geom_type == 'Polygon':
+        arc_coords = arc.exterior.coords
+    elif arc.geom_type == 'LineString':
+        arc_coords = np.linspace(list(arc.coords)[0], list(arc.coords)[1])
+    for p in list(arc_coords):
+        distance = Point(p).distance(base_poly)
+        if (distance > longest_distance) and ((remaining_empty_space.buffer(1e-9).contains(Point(p)))):
+            longest_distance = distance
+            farthest_point = Point(p)
+    point_on_poly = nearest_points(base_poly, farthest_point)[0]
+    return farthest_point, longest_distance, point_on_poly
+
+def farthest_point_cases(seed=0, num_cases=50, n=40):
+    """
+    Build a set of (arc, boundary, remaining_empty_space) inputs like the ones
+    get_farthest_point sees while filling a random polygon
+    """
+    from shapely.geometry import LineString, Point
+    import util
+
+    rng = random.Random(seed)
+    base_poly = _test_polygon(seed, 10, 15)
+    p1, p2 = util.longest_edge(base_poly)
+    boundary = LineString(util.get_boundary_line(base_poly, p1))
+    min_x, min_y, max_x, max_y = base_poly.bounds
+
+    cases = [(LineString([p1, p2]), boundary, base_poly)]
+    while len(cases) < num_cases:
+        center = Point(rng.uniform(min_x, max_x), rng.uniform(min_y, max_y))
+        if not base_poly.contains(center):
+            continue
+        filled = util.create_circle(center.x, center.y, rng.uniform(1, 5), n)
+        remaining_empty_space = base_poly.difference(filled)
+        circle = util.create_circle(center.x, center.y, rng.uniform(5, 8), n)
+        arc = util.create_arc(circle, remaining_empty_space, None, 0)
+        if arc is not None:
+            cases.append((arc, boundary, remaining_empty_space))
+    return cases
+
+def bench_farthest(repeat=5, seed=0):
+    """
+    Time util.get_farthest_point against the original implementation and check they agree.
+
+    Returns
+    -------
+    dict
+        Best time per call for both implementations (seconds), and the number of cases where the results differ
+    """
+    import util
+
+    cases = farthest_point_cases(seed)
+    mismatches = 0
+    for case in cases:
+        new = util.get_farthest_point(*case)
+        old = get_farthest_point_reference(*case)
+        if not (new[0].equals(old[0]) and new[1] == old[1]):
+            mismatches += 1
+
+    timings = {}
+    for name, function in (("vectorized", util.get_farthest_point), ("reference", get_farthest_point_reference)):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for case in cases:
+                function(*case)
+            best = min(best, (time.perf_counter() - start) / len(cases))
+        timings[name] = best
+    return {"vectorized_seconds": timings["vectorized"], "reference_seconds": timings["reference"],
+            "cases": len(cases), "mismatches": mismatches}
+
+def create_arc_reference(circle, remaining_empty_space):
+    """The original list based implementation of util.create_arc (without plotting), kept to compare against"""
+    from shapely.geometry import Polygon
+    import util
+
+    crescent = circle.intersection(remaining_empty_space)
+    crescent_exterior = util.get_exterior(crescent)
+    empty_exterior = util.get_exterior(remaining_empty_space)
+    arc = []
+    for coord in crescent_exterior:
+        if (not coord in empty_exterior) and (not coord in arc):
+            arc.append(coord)
+    if len(arc) == 0:
+        return None
+    elif len(arc) <= 2:
+        arc = Polygon(crescent_exterior).intersection(remaining_empty_space)
+    else:
+        arc = Polygon(arc)
+    start, _ = util.longest_edge(arc)
+    return Polygon(util.get_boundary_line(arc, start))
+
+def create_arc_cases(seed=0, num_holes=200, num_cases=100, n=40):
+    """
+    Build (circle, remaining_empty_space, center, radius) cases where the empty space has already had
+    lots of circles subtracted from it, like late in a fill when its exterior has many vertices
+    """
+    from shapely.geometry import Point
+    import util
+
+    rng = random.Random(seed)
+    base_poly = _test_polygon(seed, 20, 20)
+    min_x, min_y, max_x, max_y = base_poly.bounds
+
+    def random_point():
+        while True:
+            point = Point(rng.uniform(min_x, max_x), rng.uniform(min_y, max_y))
+            if base_poly.contains(point):
+                return point
+
+    remaining_empty_space = base_poly
+    for _ in range(num_holes):
+        # Holes touching the edge keep the space a single polygon with a growing exterior
+        point = base_poly.exterior.interpolate(rng.uniform(0, base_poly.exterior.length))
+        hole = util.create_circle(point.x, point.y, rng.uniform(1, 3), n)
+        remaining_empty_space = remaining_empty_space.difference(hole)
+        if remaining_empty_space.geom_type != 'Polygon':
+            remaining_empty_space = max(remaining_empty_space.geoms, key=lambda geom: geom.area)
+
+    # All circles are tested against the same empty space, like the radius loop in arc_overhang
+    cases = []
+    for _ in range(num_cases):
+        point = random_point()
+        radius = rng.uniform(1, 6)
+        cases.append((util.create_circle(point.x, point.y, radius, n), remaining_empty_space, point, radius))
+    return cases
+
+def bench_create_arc(repeat=5, seed=0):
+    """
+    Time util.create_arc against the original implementation and check the arcs are unchanged.
+    Also time util.create_arc_analytic, and measure how far its arcs are from create_arc's.
+
+    Returns
+    -------
+    dict
+        Best time per call for all three implementations (seconds), the number of vertices in the
+        empty space exterior, the number of cases where the arcs differ from the original,
+        and the largest Hausdorff distance between an analytic arc and a create_arc arc
+    """
+    import contextlib
+    import io
+    import util
+
+    cases = create_arc_cases(seed)
+    n = 40
+    def create_arc(circle, remaining_empty_space, center, radius):
+        return util.create_arc(circle, remaining_empty_space, None, 0)
+    def create_arc_analytic(circle, remaining_empty_space, center, radius):
+        return util.create_arc_analytic(center, radius, n, 0, remaining_empty_space, None, 0)
+    def create_arc_reference_case(circle, remaining_empty_space, center, radius):
+        return create_arc_reference(circle, remaining_empty_space)
+
+    # create_arc prints a message for every fully engulfed circle
+    with contextlib.redirect_stdout(io.StringIO()):
+        mismatches = 0
+        max_deviation = 0
+        for case in cases:
+            new = create_arc(*case)
+            old = create_arc_reference_case(*case)
+            if (new is None) != (old is None) or (new is not None and list(new.exterior.coords) != list(old.exterior.coords)):
+                mismatches += 1
+            analytic = create_arc_analytic(*case)
+            if new is not None and analytic is not None:
+                max_deviation = max(max_deviation, new.exterior.hausdorff_distance(analytic.exterior))
+
+        timings = {}
+        for name, function in (("hashed", create_arc), ("analytic", create_arc_analytic),
+                               ("reference", create_arc_reference_case)):
+            best = float("inf")
+            for _ in range(repeat):
+                # A fresh EmptySpace each round, so building the cached shapes is part of the timing
+                empty_space = util.EmptySpace(cases[0][1]) if name != "reference" else cases[0][1]
+                rounds = [(circle, empty_space, center, radius) for circle, _, center, radius in cases]
+                start = time.perf_counter()
+                for case in rounds:
+                    function(*case)
+                best = min(best, (time.perf_counter() - start) / len(cases))
+            timings[name] = best
+    return {"hashed_seconds": timings["hashed"], "analytic_seconds": timings["analytic"],
+            "reference_seconds": timings["reference"], "exterior_vertices": len(util.get_exterior(cases[0][1])),
+            "cases": len(cases), "mismatches": mismatches, "max_analytic_deviation": max_deviation}
+
+def bench_empty_space(seed=0, num_circles=300, n=40):
+    """
+    Fill a polygon with random circles one at a time, and after each one check which points of the
+    next circle are still empty: once by buffering the remaining empty space (the original way),
+    once with the FilledShapes registry. Every difference makes a new EmptySpace, so the buffer
+    has to be rebuilt every time, like between branches in arc_overhang.
+
+    Returns
+    -------
+    dict
+        Total time of the checks for both ways (seconds), the number of circles, and the number
+        of points where they disagree
+    """
+    from shapely.geometry import Point
+    import numpy as np
+    import util
+
+    rng = random.Random(seed)
+    base_poly = _test_polygon(seed, 20, 20)
+    min_x, min_y, max_x, max_y = base_poly.bounds
+    circles = []
+    while len(circles) < num_circles:
+        point = Point(rng.uniform(min_x, max_x), rng.uniform(min_y, max_y))
+        if base_poly.contains(point):
+            circles.append(util.create_circle(point.x, point.y, rng.uniform(0.5, 3), n))
+
+    plain = util.EmptySpace(base_poly)
+    registry = util.EmptySpace(base_poly, util.FilledShapes(base_poly))
+    timings = {"buffered": 0, "registry": 0}
+    mismatches = 0
+    for circle, next_circle in zip(circles, circles[1:]):
+        plain = util.EmptySpace(plain.polygon.difference(circle))
+        coords = np.asarray(next_circle.exterior.coords)
+        results = {}
+        start = time.perf_counter()
+        results["buffered"] = plain.contains_xy(coords[:, 0], coords[:, 1])
+        timings["buffered"] += time.perf_counter() - start
+        # Adding the circle to the registry is part of its cost
+        start = time.perf_counter()
+        registry = util.EmptySpace(plain.polygon, registry.filled.add(circle))
+        results["registry"] = registry.contains_xy(coords[:, 0], coords[:, 1])
+        timings["registry"] += time.perf_counter() - start
+        mismatches += int(np.sum(results["buffered"] != results["registry"]))
+    return {"buffered_seconds": timings["buffered"], "registry_seconds": timings["registry"],
+            "circles": num_circles, "mismatches": mismatches}
+
+def extrusion_lines(gcode):
+    """The printing moves of some gcode (G0/G1 moves that extrude, and G2/G3 arcs as straight lines) as an array of LineStrings"""
+    import re
+    import shapely
+
+    segments = []
+    position = None
+    for line in gcode.splitlines():
+        if not re.match(r"G[0-3] ", line):
+            continue
+        words = dict(re.findall(r"([XYE])(-?[\d.]+)", line))
+        if "X" not in words or "Y" not in words:
+            continue
+        point = (float(words["X"]), float(words["Y"]))
+        if position is not None and float(words.get("E", 0)) > 0 and point != position:
+            segments.append((position, point))
+        position = point
+    return shapely.linestrings(segments) if segments else shapely.linestrings([[(0, 0), (0, 0)]])[:0]
+
+def path_deviation(lines, other_lines):
+    """The largest distance from a vertex of one toolpath to the other toolpath, both ways round"""
+    import shapely
+
+    deviation = 0
+    for a, b in ((lines, other_lines), (other_lines, lines)):
+        points = shapely.points(shapely.get_coordinates(a))
+        if len(points) == 0 or len(b) == 0:
+            continue
+        _, distances = shapely.STRtree(b).query_nearest(points, return_distance=True, all_matches=False)
+        deviation = max(deviation, float(distances.max()))
+    return deviation
+
+def bench_simplify(tolerance=0.05, seed=3, avg_radius=40):
+    """
+    Fill a polygon with and without simplifying the remaining empty space.
+
+    Returns
+    -------
+    dict
+        For both runs: seconds taken, and the largest, mean and final vertex count of the remaining
+        empty space over the branches. Also the largest distance between the two toolpaths.
+    """
+    import contextlib
+    import io
+    import main
+
+    # Small circles on a big polygon, so there are lots of branches
+    params = main.resolve_params({"avg_radius": avg_radius, "num_vertices": 30, "r_min": 1, "r_max": 8})
+    base_poly = _test_polygon(seed, avg_radius, 30)
+    island = main.plan_island(base_poly, params["n"])
+
+    results = {}
+    for name, simplify_tolerance in (("exact", None), ("simplified", tolerance)):
+        settings = dict(main.fill_settings(params, simplify_tolerance=simplify_tolerance),
+                        starting_line_angle=island["starting_line_angle"])
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            fill = main.fill_island(island, settings)
+        vertices = [branch["vertices"] for branch in fill["branches"]] or [0]
+        results[name] = {"seconds": time.perf_counter() - start, "max_vertices": max(vertices),
+                         "mean_vertices": statistics.mean(vertices), "final_vertices": vertices[-1],
+                         "branches": len(fill["branches"]), "lines": extrusion_lines(fill["gcode"])}
+    results["deviation"] = path_deviation(results["exact"].pop("lines"), results["simplified"].pop("lines"))
+    return results
+
+def bench_emit(multipliers=(0.9, 1.0, 1.05, 1.1, 1.2), seed=3, avg_radius=20):
+    """
+    Fill a polygon once, then sweep the arc extrusion multiplier by only emitting the saved toolpath
+    again, and compare that with filling the polygon again for every value.
+
+    Returns
+    -------
+    dict
+        Seconds for the fill, per emission and per refill, the size of the .npz toolpath file,
+        and the number of multipliers where emitting gave different gcode than refilling
+    """
+    import contextlib
+    import io
+    import tempfile
+    import main
+    import util
+
+    params = main.resolve_params({"avg_radius": avg_radius})
+    base_poly = _test_polygon(seed, avg_radius, 15)
+    island = main.plan_island(base_poly, params["n"])
+    settings = main.fill_settings(params)
+
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        fill = main.fill_island(island, settings)
+    fill_seconds = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as directory:
+        file_name = os.path.join(directory, "toolpath.npz")
+        fill["toolpath"].save(file_name)
+        npz_bytes = os.path.getsize(file_name)
+        toolpath = util.Toolpath.load(file_name)
+
+    emit_seconds = refill_seconds = 0
+    mismatches = 0
+    for multiplier in multipliers:
+        sweep_settings = main.fill_settings(dict(params, arc_e_multiplier=multiplier))
+        start = time.perf_counter()
+        gcode_writer = util.GcodeWriter()
+        util.emit_toolpath(toolpath, gcode_writer, sweep_settings)
+        emit_seconds += time.perf_counter() - start
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            refill = main.fill_island(island, sweep_settings)
+        refill_seconds += time.perf_counter() - start
+        mismatches += gcode_writer.getvalue() != refill["gcode"]
+    return {"fill_seconds": fill_seconds, "emit_seconds": emit_seconds/len(multipliers),
+            "refill_seconds": refill_seconds/len(multipliers), "paths": len(toolpath), "npz_bytes": npz_bytes,
+            "mismatches": mismatches}
+
+# Values the corpus cases are drawn from
+CORPUS_AXES = {
+    "num_vertices": [6, 10, 15, 25],
+    "spikiness": [0.1, 0.3, 0.5],
+    "irregularity": [0.2, 0.5],
+    "avg_radius": [8, 12, 20],
+    "r_limits": [(10, 2), (8, 1.5), (5, 1)],
+    "n": [24, 40, 64],
+}
+
+def corpus_cases(corpus_seed=0, size=12):
+    """
+    A fixed list of generation cases. The same corpus_seed and size always give the same cases,
+    and every case has its own polygon seed, so the polygons don't depend on the global random state.
+
+    Returns
+    -------
+    list of dict
+        name, params for main.generate and seed for the polygon
+    """
+    rng = random.Random(corpus_seed)
+    cases = []
+    for i in range(size):
+        r_max, r_min = rng.choice(CORPUS_AXES["r_limits"])
+        params = {key: rng.choice(values) for key, values in CORPUS_AXES.items() if key != "r_limits"}
+        params.update(r_max=r_max, r_min=r_min)
+        cases.append({"name": f"case_{i:02d}", "params": params, "seed": rng.randrange(2**31)})
+    return cases
+
+def run_corpus_case(case, repeat=1):
+    """
+    Generate one corpus case. Runs in a fresh worker process, so the peak memory is its own.
+
+    Returns
+    -------
+    dict
+        Best wall time (seconds), arcs and arcs per second, seconds per stage, peak resident memory
+        of the process (MB), size and sha256 of the gcode
+    """
+    import contextlib
+    import hashlib
+    import io
+    import resource
+    import main
+    import profiling
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return main.generate(case["params"], seed=case["seed"], max_workers=1)
+
+    # Timed without the profiler, so its overhead isn't part of the speed
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        gcode = run()
+        best = min(best, time.perf_counter() - start)
+    # The arc count and the stages come from one more, profiled run
+    profiling.start()
+    run()
+    report = profiling.stop().report()
+    arcs = report["counters"].get("arcs", 0)
+    data = gcode.encode()
+    return {"name": case["name"], "seconds": best, "arcs": arcs, "arcs_per_second": arcs / best,
+            "stages": {name: entry["seconds"] for name, entry in report["stages"].items()},
+            # ru_maxrss is in kB on Linux
+            "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            "bytes": len(data), "sha256": hashlib.sha256(data).hexdigest()}
+
+def bench_corpus(corpus_seed=0, size=12, repeat=1):
+    """
+    Run every case of the corpus, each in a fresh process.
+
+    Returns
+    -------
+    dict
+        The corpus settings and the result of run_corpus_case for every case
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    cases = corpus_cases(corpus_seed, size)
+    results = []
+    for case in cases:
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            results.append(dict(executor.submit(run_corpus_case, case, repeat).result(), params=case["params"], seed=case["seed"]))
+    return {"corpus_seed": corpus_seed, "size": size, "cases": results}
+
+def compare_corpus(result, baseline, max_slowdown=0.2):
+    """
+    Compare a corpus run against an earlier one.
+
+    Returns
+    -------
+    list of str
+        A line for every case whose gcode changed, or that got more than max_slowdown slower
+    """
+    problems = []
+    previous = {case["name"]: case for case in baseline["cases"]}
+    for case in result["cases"]:
+        old = previous.get(case["name"])
+        if old is None:
+            continue
+        if case["sha256"] != old["sha256"]:
+            problems.append(f"{case['name']}: gcode changed ({old['bytes']} -> {case['bytes']} bytes)")
+        if case["seconds"] > old["seconds"]*(1 + max_slowdown):
+            problems.append(f"{case['name']}: {old['seconds']:.2f} s -> {case['seconds']:.2f} s")
+    return problems
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Arc overhang benchmarks")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    startup_parser = subparsers.add_parser("startup", help="Cold import time of the generation path")
+    startup_parser.add_argument("--repeat", type=int, default=5)
+    limits_parser = subparsers.add_parser("limits", help="Generation finishes with circles smaller than a line width")
+    limits_parser.add_argument("--timeout", type=float, default=60, help="Seconds before a case counts as hanging")
+    farthest_parser = subparsers.add_parser("farthest", help="Vectorized get_farthest_point against the original loop")
+    farthest_parser.add_argument("--repeat", type=int, default=5)
+    farthest_parser.add_argument("--seed", type=int, default=0)
+    arcs_parser = subparsers.add_parser("arcs", help="Hashed create_arc against the original list based filter, and the analytic arcs")
+    arcs_parser.add_argument("--repeat", type=int, default=5)
+    arcs_parser.add_argument("--seed", type=int, default=0)
+    empty_parser = subparsers.add_parser("empty", help="FilledShapes registry against the buffered empty space")
+    empty_parser.add_argument("--seed", type=int, default=0)
+    simplify_parser = subparsers.add_parser("simplify", help="Vertex growth and toolpath change with --simplify-tolerance")
+    simplify_parser.add_argument("--tolerance", type=float, default=0.05, help="Simplify tolerance (mm)")
+    simplify_parser.add_argument("--max-deviation", type=float, default=0.35,
+                                 help="Fail if the toolpath moves by more than this (mm, default one line width)")
+    simplify_parser.add_argument("--seed", type=int, default=3)
+    emit_parser = subparsers.add_parser("emit", help="Flow sweep by re-emitting a saved toolpath against filling again")
+    emit_parser.add_argument("--seed", type=int, default=3)
+    corpus_parser = subparsers.add_parser("corpus", help="Full generation over a fixed, seeded corpus of polygons")
+    corpus_parser.add_argument("--seed", type=int, default=0, help="Corpus seed")
+    corpus_parser.add_argument("--size", type=int, default=12, help="Number of cases")
+    corpus_parser.add_argument("--repeat", type=int, default=1, help="Runs per case, the fastest counts")
+    corpus_parser.add_argument("--output", help="Save the results to this JSON file")
+    corpus_parser.add_argument("--baseline", help="Results of an earlier run to compare against")
+    corpus_parser.add_argument("--max-slowdown", type=float, default=0.2,
+                               help="With --baseline, fail if a case gets slower by more than this fraction")
+    args = parser.parse_args(argv)
+
+    if args.benchmark == "startup":
+        result = bench_startup(args.repeat)
+        print(f"import main: median {result['median_seconds']*1000:.1f} ms, min {result['min_seconds']*1000:.1f} ms")
+        if result["heavy_modules"]:
+            print("Heavy packages imported on the generation path:", ", ".join(result["heavy_modules"]))
+            return 1
+    elif args.benchmark == "limits":
+        results = bench_limits(timeout=args.timeout)
+        for result in results:
+            outcome = f"{result['seconds']:.2f} s" if result["error"] is None else f"FAILED: {result['error']}"
+            print(f"{result['params']} seed {result['seed']}: {outcome}")
+        if any(result["error"] for result in results):
+            return 1
+    elif args.benchmark == "farthest":
+        result = bench_farthest(args.repeat, args.seed)
+        print(f"get_farthest_point: {result['vectorized_seconds']*1e6:.0f} us per call, "
+              f"original loop: {result['reference_seconds']*1e6:.0f} us per call "
+              f"({result['reference_seconds']/result['vectorized_seconds']:.1f}x), {result['cases']} cases")
+        if result["mismatches"]:
+            print(f"Results differ from the original in {result['mismatches']} cases")
+            return 1
+    elif args.benchmark == "arcs":
+        result = bench_create_arc(args.repeat, args.seed)
+        print(f"create_arc: {result['hashed_seconds']*1e6:.0f} us per call, "
+              f"original: {result['reference_seconds']*1e6:.0f} us per call "
+              f"({result['reference_seconds']/result['hashed_seconds']:.1f}x), {result['cases']} cases, "
+              f"{result['exterior_vertices']} vertices in the empty space")
+        print(f"create_arc_analytic: {result['analytic_seconds']*1e6:.0f} us per call "
+              f"({result['hashed_seconds']/result['analytic_seconds']:.1f}x faster than create_arc), "
+              f"arcs at most {result['max_analytic_deviation']:.4f} mm from create_arc's")
+        if result["mismatches"]:
+            print(f"Arcs differ from the original in {result['mismatches']} cases")
+            return 1
+    elif args.benchmark == "empty":
+        result = bench_empty_space(args.seed)
+        print(f"Still empty checks over {result['circles']} circles: buffered polygon {result['buffered_seconds']*1000:.0f} ms, "
+              f"registry {result['registry_seconds']*1000:.0f} ms "
+              f"({result['buffered_seconds']/result['registry_seconds']:.1f}x)")
+        if result["mismatches"]:
+            print(f"The registry disagrees on {result['mismatches']} points")
+            return 1
+    elif args.benchmark == "simplify":
+        result = bench_simplify(args.tolerance, args.seed)
+        for name in ("exact", "simplified"):
+            run = result[name]
+            print(f"{name}: {run['seconds']:.2f} s, {run['branches']} branches, empty space vertices "
+                  f"max {run['max_vertices']}, mean {run['mean_vertices']:.0f}, final {run['final_vertices']}")
+        print(f"Toolpath moved by at most {result['deviation']:.4f} mm (allowed {args.max_deviation} mm)")
+        if result["deviation"] > args.max_deviation:
+            return 1
+    elif args.benchmark == "emit":
+        result = bench_emit(seed=args.seed)
+        print(f"Fill: {result['fill_seconds']:.2f} s, {result['paths']} paths, {result['npz_bytes']/1024:.0f} kB as .npz")
+        print(f"Per flow setting: emit {result['emit_seconds']*1000:.1f} ms, fill again {result['refill_seconds']*1000:.0f} ms "
+              f"({result['refill_seconds']/result['emit_seconds']:.0f}x)")
+        if result["mismatches"]:
+            print(f"Emitted gcode differs from a new fill for {result['mismatches']} settings")
+            return 1
+    elif args.benchmark == "corpus":
+        result = bench_corpus(args.seed, args.size, args.repeat)
+        for case in result["cases"]:
+            print(f"{case['name']}: {case['seconds']:.2f} s, {case['arcs']} arcs ({case['arcs_per_second']:.0f}/s), "
+                  f"{case['peak_memory_mb']:.0f} MB, {case['bytes']} bytes, {case['sha256'][:12]}")
+        print(f"Total {sum(case['seconds'] for case in result['cases']):.2f} s")
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(result, f, indent=2)
+        if args.baseline:
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)
+            if (baseline["corpus_seed"], baseline["size"]) != (args.seed, args.size):
+                print("The baseline was made from a different corpus")
+                return 1
+            problems = compare_corpus(result, baseline, args.max_slowdown)
+            for problem in problems:
+                print(problem)
+            if problems:
+                return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
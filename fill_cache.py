@@ -0,0 +1,128 @@
+"""
+On-disk cache of filled islands, so the same overhang shape with the same settings is only ever
+filled once, wherever it sits on the build plate.
+
+What is stored is the toolpath of the fill (util.Toolpath, as .npz), not its gcode. The key is a
+hash of the island's coordinates relative to its first vertex plus the settings that change the
+shape of the arcs, so a moved copy of a shape hits the cache: its toolpath is moved to the new
+position and emitted again with util.emit_toolpath. Settings that only change the emitted gcode
+(flow, feedrate, G2/G3 arcs, ...) aren't part of the key, so changing them still hits the cache.
+The cache is bounded in size: when it grows past max_bytes, the entries that were used longest
+ago are deleted.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+import shapely
+
+import util
+
+# Coordinates are rounded to this many decimals for the key, so float noise from moving a shape doesn't matter
+KEY_DECIMALS = 6
+
+DEFAULT_MAX_BYTES = 256*1024*1024
+
+# Settings only used when the toolpath is turned into gcode (see util.emit_toolpath), left out of the key.
+# Anything else, including settings added later, changes the key.
+EMIT_SETTINGS = {"layer_height", "filament_diameter", "e_multiplier", "feedrate", "gcode_arcs", "retract_min_travel",
+                 "profile"}
+
+def island_key(base_poly, settings):
+    """
+    Hash an island and the settings that change how it is filled.
+
+    Returns
+    -------
+    key: str
+        Hex digest, the same for translated copies of the same polygon
+    origin: (float, float)
+        The first vertex of the polygon, which the key is relative to
+    """
+    coords = shapely.get_coordinates(base_poly)
+    origin = coords[0]
+    relative = np.round(coords - origin, KEY_DECIMALS) + 0.0  # + 0.0 turns -0.0 into 0.0
+    ring_sizes = [int(shapely.get_num_coordinates(ring)) for ring in shapely.get_rings(base_poly)]
+    digest = hashlib.sha256()
+    digest.update(relative.astype('<f8').tobytes())
+    digest.update(json.dumps(ring_sizes).encode())
+    digest.update(json.dumps({key: value for key, value in settings.items() if key not in EMIT_SETTINGS},
+                             sort_keys=True, default=float).encode())
+    return digest.hexdigest(), (float(origin[0]), float(origin[1]))
+
+class FillCache:
+    """
+    Parameters
+    ----------
+    directory: str
+        Where the cached fills are kept. Can be shared between processes.
+
+    max_bytes: int
+        Size the cache is trimmed back to after every new entry
+    """
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def get(self, base_poly, settings):
+        """
+        The cached fill of an island, moved to where base_poly is and emitted with settings, or None
+        if it hasn't been filled before. The result looks like the one from main.fill_island (without a preview).
+        """
+        key, origin = island_key(base_poly, settings)
+        try:
+            with np.load(self._path(key)) as data:
+                toolpath = util.Toolpath.from_arrays(data)
+                cached_origin = data["origin"]
+                branches = json.loads(str(data["branches"]))
+            # Mark it as recently used
+            os.utime(self._path(key))
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        dx, dy = origin[0] - cached_origin[0], origin[1] - cached_origin[1]
+        if (dx, dy) != (0, 0):
+            toolpath = toolpath.translate(dx, dy)
+        gcode_writer = util.GcodeWriter()
+        util.emit_toolpath(toolpath, gcode_writer, settings)
+        return {"gcode": gcode_writer.getvalue(), "start": gcode_writer.first_position, "end": gcode_writer.last_position,
+                "preview": None, "branches": branches, "toolpath": toolpath, "profile": None}
+
+    def put(self, base_poly, settings, fill):
+        """Store the toolpath of a result of main.fill_island for an island"""
+        key, origin = island_key(base_poly, settings)
+        # Write to a temporary file first, so other processes never see half an entry
+        handle, temporary = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(handle, 'wb') as f:
+            fill["toolpath"].save(f, origin=np.array(origin), branches=np.array(json.dumps(fill["branches"])))
+        os.replace(temporary, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Delete the least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for item in os.scandir(self.directory):
+            if item.name.endswith(".npz"):
+                try:
+                    stat = item.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, item.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
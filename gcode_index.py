@@ -0,0 +1,227 @@
+"""
+Index of where every layer and feature starts in a gcode file, so a layer or a region can be read
+with a single seek instead of scanning the text again.
+
+Usage:
+    python gcode_index.py testprint3_hard.gcode                 # build (or load) the index and summarize it
+    python gcode_index.py part.gcode --layer 12                 # print one layer
+    python gcode_index.py part.gcode --layer 12 --type "Bridge infill"
+
+The file is memory-mapped and scanned once. The byte offsets of every layer change comment
+(;LAYER_CHANGE or ;LAYER:), feature type comment (;TYPE:) and Z move are stored as NumPy arrays
+in a sidecar file next to the gcode (part.gcode.index.npz), which is reused as long as the gcode
+file hasn't changed. Files without layer comments (like the ones main.py writes) get a new layer
+at every Z move that changes the height.
+"""
+import argparse
+import mmap
+import os
+import re
+
+import numpy as np
+
+INDEX_SUFFIX = ".index.npz"
+
+# Kinds of events in the index
+LAYER_CHANGE = 0
+FEATURE_TYPE = 1
+Z_MOVE = 2
+
+EVENT_PATTERN = re.compile(rb"^(?:(;LAYER_CHANGE|;LAYER:)|;TYPE:([^\r\n]*)|G[01](?:[ \t][^\r\n;]*?)?[ \t]Z(-?\d*\.?\d+))", re.M)
+
+class GcodeIndex:
+    """
+    Byte offsets of the layers, features and Z moves of a gcode file.
+
+    Parameters
+    ----------
+    path: str
+        The gcode file
+
+    offsets: array of int64
+        Byte offset of the start of the line of every event, in file order
+
+    kinds: array of uint8
+        LAYER_CHANGE, FEATURE_TYPE or Z_MOVE for every event
+
+    values: array of float64
+        Z for Z moves, the position in type_names for feature types, NaN for layer changes
+
+    type_names: list of str
+        Every feature type found in the file
+
+    size, mtime_ns: int
+        Size and modification time of the gcode file when it was indexed
+    """
+    def __init__(self, path, offsets, kinds, values, type_names, size, mtime_ns):
+        self.path = path
+        self.offsets = offsets
+        self.kinds = kinds
+        self.values = values
+        self.type_names = list(type_names)
+        self.size = size
+        self.mtime_ns = mtime_ns
+        self._mmap = None
+        self._file = None
+
+        if np.any(kinds == LAYER_CHANGE):
+            self.layer_starts = offsets[kinds == LAYER_CHANGE]
+        else:
+            # No layer comments, so every change of height starts a new layer
+            z_offsets = offsets[kinds == Z_MOVE]
+            z_values = values[kinds == Z_MOVE]
+            changed = np.ones(len(z_values), dtype=bool)
+            changed[1:] = z_values[1:] != z_values[:-1]
+            self.layer_starts = z_offsets[changed]
+        self.layer_ends = np.append(self.layer_starts[1:], size).astype(np.int64)
+
+        # Height of every layer: the first Z move in it, or the last one before it
+        z_offsets = offsets[kinds == Z_MOVE]
+        z_values = values[kinds == Z_MOVE]
+        self.layer_z = np.full(len(self.layer_starts), np.nan)
+        if len(z_values):
+            first = np.searchsorted(z_offsets, self.layer_starts)
+            inside = first < len(z_offsets)
+            inside[inside] = z_offsets[first[inside]] < self.layer_ends[inside]
+            pick = np.where(inside, first, first - 1)
+            self.layer_z[pick >= 0] = z_values[pick[pick >= 0]]
+
+    def __len__(self):
+        """Number of layers"""
+        return len(self.layer_starts)
+
+    def layer_range(self, layer):
+        """Start and end byte offset of a layer"""
+        return int(self.layer_starts[layer]), int(self.layer_ends[layer])
+
+    def layer_at_z(self, z):
+        """The first layer printed at height z (within 1e-6 mm), or None"""
+        matches = np.nonzero(np.abs(self.layer_z - z) < 1e-6)[0]
+        return int(matches[0]) if len(matches) else None
+
+    def feature_ranges(self, layer, feature_type):
+        """
+        Start and end byte offsets of every block of a feature type in a layer.
+        A block runs until the next feature type comment or the end of the layer.
+        """
+        start, end = self.layer_range(layer)
+        first, last = np.searchsorted(self.offsets, [start, end])
+        type_offsets = self.offsets[first:last][self.kinds[first:last] == FEATURE_TYPE]
+        type_ids = self.values[first:last][self.kinds[first:last] == FEATURE_TYPE]
+        block_ends = np.append(type_offsets[1:], end)
+        if feature_type not in self.type_names:
+            return []
+        wanted = type_ids == self.type_names.index(feature_type)
+        return [(int(block_start), int(block_end)) for block_start, block_end in zip(type_offsets[wanted], block_ends[wanted])]
+
+    def read(self, start, end):
+        """The bytes between two offsets, read through the memory map"""
+        if self._mmap is None:
+            self._file = open(self.path, 'rb')
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap[start:end]
+
+    def read_layer(self, layer):
+        """The gcode of a layer, as bytes"""
+        return self.read(*self.layer_range(layer))
+
+    def close(self):
+        """Release the memory map"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def is_current(self):
+        """True if the gcode file hasn't changed since it was indexed"""
+        stat = os.stat(self.path)
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+    def save(self, index_file=None):
+        """Write the index to its sidecar file (path + INDEX_SUFFIX)"""
+        np.savez(index_file or self.path + INDEX_SUFFIX, offsets=self.offsets, kinds=self.kinds, values=self.values,
+                 type_names=np.array(self.type_names, dtype=str), size=self.size, mtime_ns=self.mtime_ns)
+
+    @classmethod
+    def load(cls, path, index_file=None):
+        """Read the index of path from its sidecar file"""
+        with np.load(index_file or path + INDEX_SUFFIX) as data:
+            return cls(path, data["offsets"], data["kinds"], data["values"], data["type_names"].tolist(),
+                       int(data["size"]), int(data["mtime_ns"]))
+
+def build_index(path):
+    """
+    Scan a gcode file once and index it.
+
+    Parameters
+    ----------
+    path: str
+        The gcode file
+
+    Returns
+    -------
+    GcodeIndex
+    """
+    stat = os.stat(path)
+    offsets, kinds, values = [], [], []
+    type_names = []
+    type_ids = {}
+    if stat.st_size > 0:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            for match in EVENT_PATTERN.finditer(data):
+                layer_change, feature_type, z = match.groups()
+                offsets.append(match.start())
+                if layer_change is not None:
+                    kinds.append(LAYER_CHANGE)
+                    values.append(np.nan)
+                elif feature_type is not None:
+                    name = feature_type.decode(errors='replace').strip()
+                    if name not in type_ids:
+                        type_ids[name] = len(type_names)
+                        type_names.append(name)
+                    kinds.append(FEATURE_TYPE)
+                    values.append(type_ids[name])
+                else:
+                    kinds.append(Z_MOVE)
+                    values.append(float(z))
+    return GcodeIndex(path, np.array(offsets, dtype=np.int64), np.array(kinds, dtype=np.uint8),
+                      np.array(values, dtype=np.float64), type_names, stat.st_size, stat.st_mtime_ns)
+
+def load_index(path):
+    """
+    The index of a gcode file, from its sidecar file if that is up to date.
+    Otherwise the file is indexed and the sidecar written.
+    """
+    if os.path.exists(path + INDEX_SUFFIX):
+        index = GcodeIndex.load(path)
+        if index.is_current():
+            return index
+    index = build_index(path)
+    index.save()
+    return index
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Index the layers and features of a gcode file")
+    parser.add_argument("gcode", help="Gcode file to index")
+    parser.add_argument("--layer", type=int, help="Print the gcode of this layer")
+    parser.add_argument("--type", dest="feature_type", help="With --layer, only print the blocks of this feature type")
+    args = parser.parse_args(argv)
+
+    with load_index(args.gcode) as index:
+        if args.layer is None:
+            print(f"{len(index)} layers, {len(index.offsets)} events, feature types: {', '.join(index.type_names) or 'none'}")
+            return 0
+        ranges = index.feature_ranges(args.layer, args.feature_type) if args.feature_type else [index.layer_range(args.layer)]
+        for start, end in ranges:
+            print(index.read(start, end).decode(errors='replace'), end="")
+    return 0
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main_cli())
@@ -1,318 +1,601 @@
-from http.client import PROCESSING
-import shapely
-from shapely.geometry import Point, Polygon, LineString, GeometryCollection
+import argparse
+import json
+import random
+from concurrent.futures import ProcessPoolExecutor
+from shapely.geometry import Point, Polygon, LineString
 from shapely import affinity
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import moviepy.editor as mp
 import numpy as np
 import os
+import fill_cache
+import profiling
 import util
-import imageio
-import os
-from tkinter import *
-import tk
-import tkinter 
-from tkinter import messagebox
 
+# Plotting (geopandas, matplotlib), video (imageio, see animation.py) and GUI (tkinter) packages
+# are only imported where they are used, so generating gcode only needs shapely and numpy.
 
-top = tkinter.Tk()
-top.title("Arc GEN")
-label_list = [
-     ["Arc generator",            0]
-    ,["Line width",               0.35]
-    ,["Layer height",             0.4]
-    ,["Arc extrusion multiplier", 1.05]
-    ,["Feedrate",                 2]
-    ,["BrimWidth",                5]
-    ,["Overhang Height",          20]
-    ,["Filament DIA",             1.75]
-    ,["Base Height",              0.5]
-    ,["Max circle radius",        10]
-    ,["Min circle radius",        2]
-    ,["Points per circle",        40]
-    ,["Radius of random polygon", 10]
-    ,["Polygon irregularity",     0.5]
-    ,["Polygon spikiness",        0.3]
-    ,["Polygon num vertices",     15]
-    ,["X Axis position",          100]
-    ,["Y Axis position",          50]]
-L = []
-for i, label in enumerate(label_list):
-    L.append("nothing")
-    L[i] = Label(top, text=label_list[i][0],).grid(row=i,column=0)
-
-
-E = []
-for i in range(len(label_list)-1):
-    E.append("nothing")
-    E[i] = Entry(top, bd =5)
-    E[i].grid(row = i+1,column=1)
-    E[i].insert(i, str(label_list[i+1][1]))
-
-def proces():
-    global LINE_WIDTH
-    i = 0
-    LINE_WIDTH=float(Entry.get(E[i]))
-    i += 1
-    global LAYER_HEIGHT
-    LAYER_HEIGHT = float(Entry.get(E[i]))
-    i += 1
-    global ARC_E_MULTIPLIER
-    ARC_E_MULTIPLIER = float(Entry.get(E[i]))
-    i += 1
-    global FEEDRATE
-    FEEDRATE = float(Entry.get(E[i]))
-    i += 1
-    global BRIM_WIDTH
-    BRIM_WIDTH = float(Entry.get(E[i]))
-    i += 1
-    global OVERHANG_HEIGHT
-    OVERHANG_HEIGHT = float(Entry.get(E[i]))
-    i += 1
-    global FILAMENT_DIAMETER
-    FILAMENT_DIAMETER = float(Entry.get(E[i]))
-    i += 1
-    global BASE_HEIGHT
-    BASE_HEIGHT = float(Entry.get(E[i]))
-    i += 1
-    global R_MAX
-    R_MAX = float(Entry.get(E[i]))
-    i += 1
-    global R_MIN
-    R_MIN = float(Entry.get(E[i]))
-    i += 1
-    global N
-    N = float(Entry.get(E[i]))
-    i += 1
-    global  avg_radius
-    avg_radius = float(Entry.get(E[i]))
-    i += 1
-    global irregularity
-    irregularity = float(Entry.get(E[i]))
-    i += 1
-    global spikiness
-    spikiness = float(Entry.get(E[i]))
-    i += 1
-    global num_vertices
-    num_vertices = float(Entry.get(E[i]))
-    i += 1
-    global x_axis
-    x_axis = float(Entry.get(E[i]))
-    i += 1
-    global y_axis
-    y_axis = float(Entry.get(E[i]))
-    top.destroy()
-
-B=Button(top, text ="Generate",command= proces).grid(row=19,column=1)
-top.mainloop()
-
-# Hard-coded recursion information
-THRESHOLD = R_MIN  #5 # How much of a 'buffer' the arcs leave around the base polygon. Don't set it negative or bad things happen.
-MIN_ARCS = np.floor(R_MIN/LINE_WIDTH)
 OUTPUT_FILE_NAME = "output/output.gcode"
 
-# Create a figure that we can plot stuff onto
-fig, ax = plt.subplots(1, 2)
-ax[0].set_aspect('equal')
-ax[1].set_aspect('equal')
-ax[0].title.set_text('Gcode Preview')
-ax[1].title.set_text('Rainbow Visualization')
-
-# Create a list of image names
-image_name_list = []
-
-# Delete all previous images
-current_directory = "./"
-files_in_directory = os.listdir(current_directory)
-for item in files_in_directory:
-    if item.endswith(".png"):
-        os.remove(os.path.join(current_directory, item))
-
-# Create a new gcode file
-os.makedirs(os.path.dirname(OUTPUT_FILE_NAME), exist_ok=True)
-with open(OUTPUT_FILE_NAME, 'w') as gcode_file:
-    gcode_file.write(""";gcode for ArcOverhang. Created by Steven McCulloch\n""")
-
-# Add start gcode
-with open('input/start.gcode','r') as start_gcode, open(OUTPUT_FILE_NAME,'a') as gcode_file:
-    for line in start_gcode:
-        gcode_file.write(line)
-
-# Create base polygon. The base polygon is the shape that will be filled by arcs
-#base_poly = util.create_rect(150, 20, 20, 20, True)
-
-# Make the base polygon a randomly generated shape
-base_poly = Polygon(util.generate_polygon(center=(x_axis, y_axis),
-                                         avg_radius=avg_radius,
-                                         irregularity=irregularity,
-                                         spikiness=spikiness,
-                                         num_vertices=num_vertices,))
-
-# Find starting edge (in this implementation, it just finds the largest edge to start from.
-# TODO Allow multiple starting points
-# TODO Come up with some way to determine starting edges based on geometry of previous layer
+# [Label shown in the GUI, default value, parameter name used by generate() and config files]
+label_list = [
+     ["Arc generator",            0,    None]
+    ,["Line width",               0.35, "line_width"]
+    ,["Layer height",             0.4,  "layer_height"]
+    ,["Arc extrusion multiplier", 1.05, "arc_e_multiplier"]
+    ,["Feedrate",                 2,    "feedrate"]
+    ,["BrimWidth",                5,    "brim_width"]
+    ,["Overhang Height",          20,   "overhang_height"]
+    ,["Filament DIA",             1.75, "filament_diameter"]
+    ,["Base Height",              0.5,  "base_height"]
+    ,["Max circle radius",        10,   "r_max"]
+    ,["Min circle radius",        2,    "r_min"]
+    ,["Points per circle",        40,   "n"]
+    ,["Radius of random polygon", 10,   "avg_radius"]
+    ,["Polygon irregularity",     0.5,  "irregularity"]
+    ,["Polygon spikiness",        0.3,  "spikiness"]
+    ,["Polygon num vertices",     15,   "num_vertices"]
+    ,["X Axis position",          100,  "x_axis"]
+    ,["Y Axis position",          50,   "y_axis"]]
+
+DEFAULT_PARAMS = {key: default for _, default, key in label_list[1:]}
+
+def resolve_params(params):
+    """
+    Check params against label_list and fill in the defaults for anything left out.
+    Raises ValueError for unknown parameter names.
+    """
+    unknown = set(params) - set(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown parameters: {', '.join(sorted(unknown))}")
+    return {key: float(value) for key, value in {**DEFAULT_PARAMS, **params}.items()}
+
+def positive_float(text):
+    """argparse type for settings that must be above 0"""
+    value = float(text)
+    if not value > 0:
+        raise argparse.ArgumentTypeError(f"must be above 0, got {text}")
+    return value
+
+def non_negative_float(text):
+    """argparse type for settings that can't be negative"""
+    value = float(text)
+    if not value >= 0:
+        raise argparse.ArgumentTypeError(f"can't be negative, got {text}")
+    return value
+
+def fill_settings(params, max_depth=None, max_arcs=None, analytic_arcs=False, chord_tolerance=None, gcode_arcs=False,
+                  simplify_tolerance=None, optimize_order=False):
+    """
+    Turn params (from resolve_params) into the settings used by fill_island and util.arc_overhang.
+    See generate for the other arguments. Raises ValueError for a chord_tolerance that isn't above 0
+    or a negative simplify_tolerance.
+    """
+    # Without a tolerance above 0 no number of segments is enough, and circle_resolution breaks
+    if chord_tolerance is not None and not chord_tolerance > 0:
+        raise ValueError(f"chord_tolerance must be above 0, got {chord_tolerance}")
+    # Shapely only finds out halfway through filling, with a GEOSException
+    if simplify_tolerance is not None and not simplify_tolerance >= 0:
+        raise ValueError(f"simplify_tolerance can't be negative, got {simplify_tolerance}")
+    return {
+        "line_width": params["line_width"],
+        "layer_height": params["layer_height"],
+        "filament_diameter": params["filament_diameter"],
+        "e_multiplier": params["arc_e_multiplier"],
+        "feedrate": params["feedrate"],
+        "n": params["n"],
+        "r_max": params["r_max"],
+        # How much of a 'buffer' the arcs leave around the base polygon. Don't set it negative or bad things happen.
+        "threshold": params["r_min"],
+        "min_arcs": np.floor(params["r_min"]/params["line_width"]),
+        "max_depth": max_depth,
+        "max_arcs": max_arcs,
+        "analytic_arcs": analytic_arcs,
+        "chord_tolerance": chord_tolerance,
+        "gcode_arcs": gcode_arcs,
+        "simplify_tolerance": simplify_tolerance,
+        "optimize_order": optimize_order,
+        # Reordered arcs mostly start right next to where the previous one ended, no need to retract for that
+        "retract_min_travel": 2*params["line_width"] if optimize_order else 0,
+    }
+
+def plan_island(base_poly, N):
+    """
+    Work out where the tower and the first arc go for one island of the base region.
+
+    Parameters
+    ----------
+    base_poly: Polygon
+        The island to fill
+
+    N: float
+        Points per circle
+
+    Returns
+    -------
+    dict
+        The island, its starting line and the boundary line the arcs build out to,
+        the center and radius of the first arc and the angle of the starting line
+    """
+    # The space left to fill, with cached shapes derived from it for faster queries
+    base_space = util.EmptySpace(base_poly)
+
+    # Find starting edge (in this implementation, it just finds the largest edge to start from.
+    # TODO Allow multiple starting points
+    # TODO Come up with some way to determine starting edges based on geometry of previous layer
  
-p1, p2 = util.longest_edge(base_poly)
-starting_line = LineString([p1, p2])
-
-# Copy the base polygon, but exclude the starting (longest) line, turning it from a closed Polygon to an open LineString
-boundary_line = LineString(util.get_boundary_line(base_poly, p1))
-
-# Create the first arc
-starting_point, r_start, r_farthest = util.get_farthest_point(starting_line, boundary_line, base_poly)
-starting_circle_norot = util.create_circle(starting_point.x, starting_point.y, r_start, N)
-starting_line_angle = np.arctan2((p2.y-p1.y),(p2.x-p1.x))
-starting_circle = affinity.rotate(starting_circle_norot, starting_line_angle, origin = 'centroid', use_radians=True)
-starting_arc = starting_circle.intersection(base_poly)
-
-# plot base poly
-base_poly_geoseries = gpd.GeoSeries(base_poly)
-base_poly_geoseries.plot(ax=ax[0], color='white', edgecolor='black', linewidth=1)
-base_poly_geoseries.plot(ax=ax[1], color='white', edgecolor='black', linewidth=1)
-
-# plot starting line
-starting_line_geoseries = gpd.GeoSeries(starting_line)
-starting_line_geoseries.plot(ax=ax[0], color='red', linewidth=2)
-
-# Generate 3d printed starting tower
-curr_z = LAYER_HEIGHT  # Height of first layer
-with open(OUTPUT_FILE_NAME, 'a') as gcode_file:
-    gcode_file.write(f"G0 X{'{0:.3f}'.format(starting_point.x)} Y{'{0:.3f}'.format(starting_point.y)} F500\n")
-    gcode_file.write(f"G1 Z{'{0:.3f}'.format(curr_z)} F500\n")
-    gcode_file.write(";Generating first layer\n")
-    gcode_file.write("G1 E3.8\n")  # Unretract
-    
-# Fill in circles from outside to inside
-while curr_z < BASE_HEIGHT:
-    starting_tower_r = r_start + BRIM_WIDTH  
-    while starting_tower_r > LINE_WIDTH*2:
-        first_layer_circle = util.create_circle(starting_point.x, starting_point.y, starting_tower_r, N)
-        util.write_gcode(OUTPUT_FILE_NAME, first_layer_circle, LINE_WIDTH, LAYER_HEIGHT, FILAMENT_DIAMETER, 2, FEEDRATE*5, close_loop=True)
-        starting_tower_r -= LINE_WIDTH*2
-    
-    curr_z += LAYER_HEIGHT
-    with open(OUTPUT_FILE_NAME, 'a') as gcode_file:
-        gcode_file.write(f"G1 Z{'{0:.3f}'.format(curr_z)} F500\n")
-
-with open(OUTPUT_FILE_NAME, 'a') as gcode_file:
-    gcode_file.write(f"G1 Z{'{0:.3f}'.format(curr_z)} F500\n")
-    gcode_file.write(";Generating tower\n")
-    gcode_file.write("M106 S255 ;Turn on fan to max power\n") 
-    
-while curr_z < OVERHANG_HEIGHT:
-    util.write_gcode(OUTPUT_FILE_NAME, starting_line.buffer(LINE_WIDTH), LINE_WIDTH, LAYER_HEIGHT, FILAMENT_DIAMETER, 2, FEEDRATE*5, close_loop=True)
-    with open(OUTPUT_FILE_NAME, 'a') as gcode_file:
-        gcode_file.write(f"G1 Z{'{0:.3f}'.format(curr_z)} F500\n")
-    curr_z += LAYER_HEIGHT
-
-curr_z -= LAYER_HEIGHT*2
-
-with open(OUTPUT_FILE_NAME, 'a') as gcode_file:
-        gcode_file.write(f"G1 Z{'{0:.3f}'.format(curr_z)} F500\n")
+    p1, p2 = util.longest_edge(base_poly)
+    starting_line = LineString([p1, p2])
+
+    # Copy the base polygon, but exclude the starting (longest) line, turning it from a closed Polygon to an open LineString
+    boundary_line = LineString(util.get_boundary_line(base_poly, p1))
+
+    # Create the first arc
+    starting_point, r_start, r_farthest = util.get_farthest_point(starting_line, boundary_line, base_space)
+    starting_circle_norot = util.create_circle(starting_point.x, starting_point.y, r_start, N)
+    starting_line_angle = np.arctan2((p2.y-p1.y),(p2.x-p1.x))
+    starting_circle = affinity.rotate(starting_circle_norot, starting_line_angle, origin = 'centroid', use_radians=True)
+    starting_arc = starting_circle.intersection(base_poly)
+
+    return {"base_poly": base_poly, "p1": p1, "p2": p2, "starting_line": starting_line, "boundary_line": boundary_line,
+            "starting_point": starting_point, "r_start": r_start, "starting_line_angle": starting_line_angle,
+            "starting_arc": starting_arc}
+
+def fill_island(island, settings, preview=None):
+    """
+    Fill one island with arcs and perimeter rings. Runs in a worker process when there are several islands.
+
+    Parameters
+    ----------
+    island: dict
+        From plan_island
+
+    settings: dict
+        Print settings, see util.arc_overhang (starting_line_angle is taken from the island)
+
+    preview: util.Preview, optional
+        Collects the arcs for plotting
+
+    Returns
+    -------
+    dict
+        The gcode for the island, where its first and last moves are, the preview,
+        the branches reported by util.arc_overhang, the util.Toolpath the gcode was made from,
+        and the profiling report when it ran in a worker process
+    """
+    # In a worker process, record into a profiler of our own and send its report back with the result
+    own_profiler = settings.get("profile", False)
+    if own_profiler:
+        profiling.start()
+    timer = profiling.Timer()
+    LINE_WIDTH = settings["line_width"]
+    N = settings["n"]
+    THRESHOLD = settings["threshold"]
+    base_poly = island["base_poly"]
+    # Keep track of the filled circles in a spatial index, for fast "is this point still empty" checks
+    base_space = util.EmptySpace(base_poly, util.FilledShapes(base_poly), settings.get("simplify_tolerance"))
+    p1, p2 = island["p1"], island["p2"]
+    boundary_line = island["boundary_line"]
+    starting_point = island["starting_point"]
+    r_start = island["r_start"]
+    starting_line_angle = island["starting_line_angle"]
+    settings = dict(settings, starting_line_angle=starting_line_angle)
+    # The arcs are collected as geometry first, and only turned into gcode at the end
+    toolpath = util.Toolpath()
+
+    # Create multiple layers
+    r = LINE_WIDTH
+    small_arc_radius = 0.5 # Arcs smaller than this get reduced speed and/or flow settings.
+    curr_arc = island["starting_arc"]
+
+    # Overlap arc with the starting line
+    starting_point = util.move_toward_point(starting_point, affinity.rotate(p1, 90, LineString([p1, p2]).centroid), LINE_WIDTH*0.5) 
+
+    # Create arcs until we reach the edge of the polygon
+    radii = []
+    while r < r_start-THRESHOLD:
+        radii.append(r)
+        r += LINE_WIDTH
 
-# Create multiple layers
-r = LINE_WIDTH
-small_arc_radius = 0.5 # Arcs smaller than this get reduced speed and/or flow settings.
-curr_arc = starting_arc
+    segments = util.circle_resolution(radii, N, settings.get("chord_tolerance"))
 
-# Overlap arc with the starting line
-starting_point = util.move_toward_point(starting_point, affinity.rotate(p1, 90, LineString([p1, p2]).centroid), LINE_WIDTH*0.5) 
+    # Every arc is cut from the base polygon, so they can all be made in one go
+    arcs, next_circle = util.make_branch_arcs(starting_point, radii, segments, starting_line_angle, base_space, preview,
+                                              0, settings.get("analytic_arcs"))
 
-# Create arcs until we reach the edge of the polygon
-while r < r_start-THRESHOLD:
+    for r, n, next_arc in zip(radii, segments, arcs):
+        if not next_arc:
+            continue
+        curr_arc = Polygon(next_arc)
+
+        #Slow down and reduce flow for all small arcs
+        modifier = util.SMALL_ARC if r < small_arc_radius else util.FULL_SPEED
 
-    # Create a circle based on point location, radius, n
-    next_circle = Polygon(util.create_circle(starting_point.x, starting_point.y, r, N))
-    next_circle = affinity.rotate(next_circle, starting_line_angle, origin = 'centroid', use_radians=True)
+        # Add it to the toolpath
+        toolpath.add(next_arc, False, 0, (starting_point.x, starting_point.y, r, n), modifier)
 
-    # Plot arc
-    next_arc = util.create_arc(next_circle, base_poly, ax, depth=0)
-    if not next_arc:
-        r += LINE_WIDTH
-        continue
-    curr_arc = Polygon(next_arc)
-
-    #Slow down and reduce flow for all small arcs
-    if r < small_arc_radius:
-        speed_modifier = 0.25
-        e_modifier = 0.25
-    else: 
-        speed_modifier = 1
-        e_modifier = 1
-
-    # Write gcode to file
-    util.write_gcode(OUTPUT_FILE_NAME, next_arc, LINE_WIDTH, LAYER_HEIGHT, FILAMENT_DIAMETER, ARC_E_MULTIPLIER*e_modifier, FEEDRATE*speed_modifier, close_loop=False)
+    profiling.count("arcs", sum(1 for next_arc in arcs if next_arc))
+    timer.lap("first_arcs")
+    remaining_empty_space = base_space.difference(curr_arc)
+
+    # If there's room for arcs to be built on top of the current arc, then do it!
+    remaining_empty_space, branches = util.arc_overhang(curr_arc, boundary_line, remaining_empty_space, next_circle,
+                                                        settings, toolpath, preview)
+
+    timer.lap("fill")
+
+    # Add concentric rings around the outside of the perimeter
+    boundary_poly = Polygon(boundary_line)
+    for line in util.perimeter_rings(boundary_poly, remaining_empty_space, LINE_WIDTH):
+        # plot ring
+        if preview is not None:
+            preview.add_ring(line)
+        toolpath.add(line, False)
+
+    timer.lap("perimeter_rings")
+
+    if settings.get("optimize_order"):
+        before = util.estimate_print_time(toolpath, dict(settings, retract_min_travel=0))
+        toolpath = util.order_toolpath(toolpath, LINE_WIDTH)
+        after = util.estimate_print_time(toolpath, settings)
+        print(f"Reordered arcs: travel {before['travel']:.0f} -> {after['travel']:.0f} mm, "
+              f"retractions {before['retractions']} -> {after['retractions']}, "
+              f"about {before['seconds'] - after['seconds']:.0f} s of {before['seconds']:.0f} s saved")
+        profiling.count("seconds_saved_by_order", before["seconds"] - after["seconds"])
+        timer.lap("order")
+
+    gcode_writer = util.GcodeWriter()
+    util.emit_toolpath(toolpath, gcode_writer, settings)
+    timer.lap("emit")
+
+    return {"gcode": gcode_writer.getvalue(), "start": gcode_writer.first_position,
+            "end": gcode_writer.last_position, "preview": preview, "branches": branches, "toolpath": toolpath,
+            "profile": profiling.stop().report() if own_profiler else None}
+
+def generate(params, preview=None, max_depth=None, max_arcs=None, base_poly=None, seed=None, max_workers=None,
+             analytic_arcs=False, chord_tolerance=None, gcode_arcs=False, simplify_tolerance=None, cache_dir=None,
+             cache_max_bytes=fill_cache.DEFAULT_MAX_BYTES, optimize_order=False):
+    """
+    Generate the gcode for a complete arc overhang test print.
+
+    Parameters
+    ----------
+    params: dict
+        Print and shape settings, keyed by the parameter names in label_list.
+        Anything left out falls back to DEFAULT_PARAMS.
+
+    preview: util.Preview, optional
+        Collects the generated shapes so they can be plotted afterwards.
+        Nothing is plotted when this is left out, which is a lot faster.
+
+    max_depth: int, optional
+        Don't grow branches of arcs deeper than this
+
+    max_arcs: int, optional
+        Stop starting new branches once this many arcs have been built on the first arc.
+        Together with max_depth this caps how long a single part can take.
+
+    base_poly: Polygon or MultiPolygon, optional
+        The shape to fill with arcs. A random polygon is generated from params when this is left out.
+        Each polygon of a MultiPolygon is an island that gets its own tower and is filled separately.
+
+    seed: int, optional
+        Seed for the random polygon, so the same seed always gives the same shape.
+        Uses the global random state when left out.
+
+    max_workers: int, optional
+        Number of processes used to fill the islands of a MultiPolygon. 1 fills them one by one.
+
+    analytic_arcs: bool
+        Cut the arcs out of true circles in closed form (util.create_arc_analytic) instead of
+        intersecting polygons for every arc. Much faster, but the ends of the arcs move slightly.
+
+    chord_tolerance: float, optional
+        Choose the points per circle from its radius, so no segment is more than this many mm
+        from the true circle, instead of using n points for every circle. Must be above 0.
+
+    gcode_arcs: bool
+        Print the arcs with G2/G3 moves instead of many short G0 moves. Needs firmware with
+        arc support (e.g. Marlin with ARC_SUPPORT, Klipper with [gcode_arcs]).
+
+    simplify_tolerance: float, optional
+        Simplify the remaining empty space after every circle is taken out of it, moving its edge
+        by at most this many mm, so it doesn't keep growing more vertices. Can't be negative.
+
+    cache_dir: str, optional
+        Keep the filled islands in this folder (see fill_cache.py), and reuse them for islands of the
+        same shape and settings, wherever they are. Not used when there is a preview.
+
+    cache_max_bytes: int
+        Size limit of the cache folder. The least recently used fills are deleted to stay under it.
+
+    optimize_order: bool
+        Print the branches of arcs in an order that keeps travel short (see util.order_toolpath)
+        instead of the order they were made in, and don't retract for travels shorter than two
+        line widths. Prints the estimated time saved.
+
+    Returns
+    -------
+    str
+        The generated gcode
+
+    The stages are timed while a profiler is running, see profiling.py.
+    """
+    timer = profiling.Timer()
+    params = resolve_params(params)
+    # Checked before anything is generated
+    settings = fill_settings(params, max_depth, max_arcs, analytic_arcs, chord_tolerance, gcode_arcs, simplify_tolerance,
+                             optimize_order)
+    LINE_WIDTH = params["line_width"]
+    LAYER_HEIGHT = params["layer_height"]
+    ARC_E_MULTIPLIER = params["arc_e_multiplier"]
+    FEEDRATE = params["feedrate"]
+    BRIM_WIDTH = params["brim_width"]
+    OVERHANG_HEIGHT = params["overhang_height"]
+    FILAMENT_DIAMETER = params["filament_diameter"]
+    BASE_HEIGHT = params["base_height"]
+    N = params["n"]
+    avg_radius = params["avg_radius"]
+    irregularity = params["irregularity"]
+    spikiness = params["spikiness"]
+    num_vertices = params["num_vertices"]
+    x_axis = params["x_axis"]
+    y_axis = params["y_axis"]
+
+    # Create a new gcode file
+    gcode_writer = util.GcodeWriter()
+    gcode_writer.write(""";gcode for ArcOverhang. Created by Steven McCulloch\n""")
+
+    # Add start gcode
+    gcode_writer.write_file('input/start.gcode')
+
+    # Create base polygon. The base polygon is the shape that will be filled by arcs
+    #base_poly = util.create_rect(150, 20, 20, 20, True)
+
+    # Make the base polygon a randomly generated shape, unless we were given one
+    if base_poly is None:
+        base_poly = Polygon(util.generate_polygon(center=(x_axis, y_axis),
+                                                 avg_radius=avg_radius,
+                                                 irregularity=irregularity,
+                                                 spikiness=spikiness,
+                                                 num_vertices=num_vertices,
+                                                 rng=random.Random(seed) if seed is not None else None))
+
+    # Every island of the base region is filled on its own, starting from its own edge
+    islands = [plan_island(poly, N) for poly in sorted(getattr(base_poly, 'geoms', [base_poly]), key=lambda poly: -poly.area)]
+
+    # plot base poly and starting line
+    if preview is not None:
+        for island in islands:
+            preview.add_base_poly(island["base_poly"])
+            preview.add_starting_line(island["starting_line"])
+
+    timer.lap("plan")
+
+    # Visit the towers in an order that keeps travel short, going back and forth on alternate layers
+    tower_order = util.nearest_neighbour_order([island["starting_point"].coords[0] for island in islands],
+                                               [island["starting_point"].coords[0] for island in islands],
+                                               islands[0]["starting_point"].coords[0])
+    tower_orders = [[islands[i] for i in tower_order], [islands[i] for i in reversed(tower_order)]]
+    layer = 0
+
+    # Generate 3d printed starting tower
+    starting_point = islands[tower_order[0]]["starting_point"]
+    curr_z = LAYER_HEIGHT  # Height of first layer
+    gcode_writer.write(f"G0 X{'{0:.3f}'.format(starting_point.x)} Y{'{0:.3f}'.format(starting_point.y)} F500\n")
+    gcode_writer.write_z(curr_z)
+    gcode_writer.write(";Generating first layer\n")
+    gcode_writer.write("G1 E3.8\n")  # Unretract
     
-    r += LINE_WIDTH
+    # Fill in circles from outside to inside
+    while curr_z < BASE_HEIGHT:
+        for island in tower_orders[layer % 2]:
+            starting_point = island["starting_point"]
+            starting_tower_r = island["r_start"] + BRIM_WIDTH  
+            while starting_tower_r > LINE_WIDTH*2:
+                first_layer_circle = util.create_circle(starting_point.x, starting_point.y, starting_tower_r, N)
+                util.write_gcode(gcode_writer, first_layer_circle, LINE_WIDTH, LAYER_HEIGHT, FILAMENT_DIAMETER, 2, FEEDRATE*5, close_loop=True)
+                starting_tower_r -= LINE_WIDTH*2
+        layer += 1
     
-    # Create image
-    #file_name = util.image_number(image_name_list)   
-    #plt.savefig(file_name, dpi=200)
-    #image_name_list.append(file_name + ".png")
-
-remaining_empty_space = base_poly.difference(curr_arc)
-next_point, longest_distance, _ = util.get_farthest_point(curr_arc, boundary_line, base_poly)
-
-# If there's room for an arc to be built on top of the current arc, then do it!
-while longest_distance > THRESHOLD + MIN_ARCS*LINE_WIDTH: 
-    next_arc, remaining_empty_space, image_name_list = util.arc_overhang(curr_arc, boundary_line, starting_line_angle, N, 
-                                                                        remaining_empty_space, next_circle, 
-                                                                        THRESHOLD, ax, fig, 1, image_name_list, 
-                                                                        R_MAX, MIN_ARCS, LINE_WIDTH, OUTPUT_FILE_NAME,
-                                                                        LAYER_HEIGHT, FILAMENT_DIAMETER, ARC_E_MULTIPLIER,
-                                                                        FEEDRATE)
-    next_point, longest_distance, _ = util.get_farthest_point(curr_arc, boundary_line, remaining_empty_space)
-
-# Add concentric rings around the outside of the perimeter
-# TODO don't use a for loop.....
-for i in range(100):
-    first_ring = LineString(Polygon(boundary_line).buffer(-99*LINE_WIDTH + LINE_WIDTH*i).exterior.coords)
-    first_ring = first_ring.intersection(remaining_empty_space)
-    if first_ring.length <1e-9:
-        continue
-
-    if first_ring.geom_type == 'LineString':
-        line = first_ring
-        # plot starting line
-        first_ring_geoseries = gpd.GeoSeries(line)
-        first_ring_geoseries.plot(ax=ax[0], color='blue', edgecolor = 'blue', linewidth=1)
-        util.write_gcode(OUTPUT_FILE_NAME, line, LINE_WIDTH, LAYER_HEIGHT, FILAMENT_DIAMETER, ARC_E_MULTIPLIER, FEEDRATE, False)
+        curr_z += LAYER_HEIGHT
+        gcode_writer.write_z(curr_z)
+
+    gcode_writer.write_z(curr_z)
+    gcode_writer.write(";Generating tower\n")
+    gcode_writer.write("M106 S255 ;Turn on fan to max power\n") 
+    
+    while curr_z < OVERHANG_HEIGHT:
+        for island in tower_orders[layer % 2]:
+            util.write_gcode(gcode_writer, island["starting_line"].buffer(LINE_WIDTH), LINE_WIDTH, LAYER_HEIGHT, FILAMENT_DIAMETER, 2, FEEDRATE*5, close_loop=True)
+        layer += 1
+        gcode_writer.write_z(curr_z)
+        curr_z += LAYER_HEIGHT
+
+    curr_z -= LAYER_HEIGHT*2
+
+    gcode_writer.write_z(curr_z)
+
+    # Fill the islands with arcs. They don't affect each other, so with more than one island they are
+    # filled in parallel, and then printed in the order that keeps travel between them short.
+    timer.lap("tower")
+    # Islands that were filled before (here or in an earlier run) come from the cache, only the rest get filled
+    cache = fill_cache.FillCache(cache_dir, cache_max_bytes) if cache_dir is not None and preview is None else None
+    filled = [cache.get(island["base_poly"], settings) if cache is not None else None for island in islands]
+    missing = [island for island, island_fill in zip(islands, filled) if island_fill is None]
+    profiling.count("cached_islands", len(islands) - len(missing))
+    if len(missing) > 1 and max_workers != 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            island_previews = [util.Preview() if preview is not None else None for _ in missing]
+            worker_settings = dict(settings, profile=profiling.active() is not None)
+            new_fills = list(executor.map(fill_island, missing, [worker_settings]*len(missing), island_previews))
+        if preview is not None:
+            for island_fill in new_fills:
+                preview.extend(island_fill["preview"])
+        if profiling.active() is not None:
+            for island_fill in new_fills:
+                profiling.active().merge(island_fill["profile"])
     else:
-        for line in first_ring.geoms:
-            # plot starting line
-            first_ring_geoseries = gpd.GeoSeries(line)
-            first_ring_geoseries.plot(ax=ax[0], color='blue', edgecolor = 'blue', linewidth=1)
-            util.write_gcode(OUTPUT_FILE_NAME, line, LINE_WIDTH, LAYER_HEIGHT, FILAMENT_DIAMETER, ARC_E_MULTIPLIER, FEEDRATE, False)
-
-            #Make image
-            #file_name = util.image_number(image_name_list)   
-            #plt.savefig(file_name, dpi=200)
-            #image_name_list.append(file_name + ".png")
-
-"""
-# Turn images into gif + MP4
-print("Making gif")
-with imageio.get_writer('output/output_gif.gif', mode='I', fps=20) as writer:
-    for file_name in image_name_list:
-        image = imageio.imread(file_name)
-        writer.append_data(image)
-
-print("Making movie")
-clip = mp.VideoFileClip("output/output_gif.gif")
-clip.write_videofile("output/output_video.mp4")
-"""
-# Build a few layers on top of the overhanging area
-for i in range(10):
-    util.write_gcode(OUTPUT_FILE_NAME, Polygon(boundary_line).buffer(-LINE_WIDTH/2), LINE_WIDTH, LAYER_HEIGHT, FILAMENT_DIAMETER, ARC_E_MULTIPLIER, FEEDRATE*3, close_loop=True)
-    with open(OUTPUT_FILE_NAME, 'a') as gcode_file:
-        gcode_file.write(f"G1 Z{'{0:.3f}'.format(curr_z+LAYER_HEIGHT*i)} F500\n")
+        new_fills = [fill_island(island, settings, preview) for island in missing]
+    if cache is not None:
+        for island, island_fill in zip(missing, new_fills):
+            cache.put(island["base_poly"], settings, island_fill)
+    new_fills = iter(new_fills)
+    filled = [island_fill if island_fill is not None else next(new_fills) for island_fill in filled]
+    timer.lap("fill_islands")
+
+    position = tower_orders[(layer - 1) % 2][-1]["starting_point"].coords[0]
+    fill_order = util.nearest_neighbour_order([island_fill["start"] for island_fill in filled],
+                                              [island_fill["end"] for island_fill in filled], position)
+    for i in fill_order:
+        gcode_writer.write(filled[i]["gcode"])
+
+    # Build a few layers on top of the overhanging area
+    top_layers = [Polygon(islands[i]["boundary_line"]).buffer(-LINE_WIDTH/2) for i in fill_order]
+    for i in range(10):
+        for top_layer in (top_layers if i % 2 == 0 else reversed(top_layers)):
+            util.write_gcode(gcode_writer, top_layer, LINE_WIDTH, LAYER_HEIGHT, FILAMENT_DIAMETER, ARC_E_MULTIPLIER, FEEDRATE*3, close_loop=True)
+        gcode_writer.write_z(curr_z+LAYER_HEIGHT*i)
         
-# Write end gcode
-with open('input/end.gcode','r') as end_gcode, open(OUTPUT_FILE_NAME,'a') as gcode_file:
-    for line in end_gcode:
-        gcode_file.write(line)
-
-# Create image
-plt.savefig("output/output", dpi=600)
-plt.show()
\ No newline at end of file
+    # Write end gcode
+    gcode_writer.write_file('input/end.gcode')
+    timer.lap("top_layers")
+
+    return gcode_writer.getvalue()
+
+def run_gui(params):
+    """
+    Show the settings dialog, prefilled with params.
+    Returns the settings entered by the user, or None if the window was closed.
+    """
+    # Only pay for tkinter when the dialog is actually shown
+    import tkinter
+    from tkinter import Label, Entry, Button
+
+    top = tkinter.Tk()
+    top.title("Arc GEN")
+    L = []
+    for i, label in enumerate(label_list):
+        L.append("nothing")
+        L[i] = Label(top, text=label_list[i][0],).grid(row=i,column=0)
+
+    E = []
+    for i in range(len(label_list)-1):
+        E.append("nothing")
+        E[i] = Entry(top, bd =5)
+        E[i].grid(row = i+1,column=1)
+        E[i].insert(i, str(params[label_list[i+1][2]]))
+
+    entered_params = {}
+    def proces():
+        for i, label in enumerate(label_list[1:]):
+            entered_params[label[2]] = float(Entry.get(E[i]))
+        top.destroy()
+
+    B=Button(top, text ="Generate",command= proces).grid(row=19,column=1)
+    top.mainloop()
+    return entered_params or None
+
+def load_params(config_file=None, overrides=None):
+    """
+    Combine the default settings, a JSON config file and command line overrides (in that order of priority)
+    """
+    params = dict(DEFAULT_PARAMS)
+    if config_file:
+        with open(config_file, 'r') as f:
+            config = json.load(f)
+        unknown = set(config) - set(DEFAULT_PARAMS)
+        if unknown:
+            raise ValueError(f"Unknown parameters in {config_file}: {', '.join(sorted(unknown))}")
+        params.update(config)
+    for key, value in (overrides or {}).items():
+        if value is not None:
+            params[key] = value
+    return params
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate arc overhang gcode")
+    parser.add_argument("--headless", action="store_true",
+                        help="Generate straight away without showing the settings dialog")
+    parser.add_argument("--config", help="JSON file with any of the settings below")
+    parser.add_argument("--output", default=OUTPUT_FILE_NAME, help="Where to write the gcode")
+    parser.add_argument("--preview", action="store_true",
+                        help="In headless mode, also save a preview picture next to the gcode")
+    parser.add_argument("--max-depth", type=int, help="Don't grow branches of arcs deeper than this")
+    parser.add_argument("--max-arcs", type=int, help="Stop starting new branches after this many arcs")
+    parser.add_argument("--analytic-arcs", action="store_true",
+                        help="Cut arcs from true circles in closed form instead of with polygon intersections (faster)")
+    parser.add_argument("--chord-tolerance", type=positive_float,
+                        help="Pick the points per circle from its radius, keeping every segment within this many mm of the circle")
+    parser.add_argument("--gcode-arcs", action="store_true",
+                        help="Print arcs with G2/G3 moves (needs firmware arc support)")
+    parser.add_argument("--profile", metavar="FILE",
+                        help="Time every stage and the main functions, and save the report to this JSON file")
+    parser.add_argument("--simplify-tolerance", type=non_negative_float,
+                        help="Simplify the remaining empty space by up to this many mm after every circle")
+    parser.add_argument("--optimize-order", action="store_true",
+                        help="Reorder the branches of arcs to cut down on travel and retractions")
+    parser.add_argument("--animation", metavar="FILE",
+                        help="Animate the arcs being made, one frame per arc, into this GIF or MP4 file")
+    parser.add_argument("--animation-worker", action="store_true",
+                        help="Draw and encode the animation in a separate process, so generation doesn't wait for it")
+    parser.add_argument("--animation-fps", type=float, default=20, help="Frames per second of the animation")
+    parser.add_argument("--arcs-per-frame", type=int, default=1, help="Arcs drawn between animation frames")
+    parser.add_argument("--cache-dir",
+                        help="Reuse filled islands of the same shape and settings from this folder (and add new ones to it)")
+    parser.add_argument("--cache-size", type=float, default=fill_cache.DEFAULT_MAX_BYTES/2**20,
+                        help="Size limit of the cache folder in MB (default %(default)g)")
+    for label, default, key in label_list[1:]:
+        parser.add_argument("--" + key.replace("_", "-"), dest=key, type=float,
+                            help=f"{label} (default {default})")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    params = load_params(args.config, {key: getattr(args, key) for key in DEFAULT_PARAMS})
+
+    if not args.headless:
+        params = run_gui(params)
+        if params is None:
+            return
+
+    if args.profile:
+        profiling.start()
+    timer = profiling.Timer()
+
+    # The preview is always shown when using the dialog
+    show_preview = args.preview or not args.headless
+    if args.animation:
+        # Only imports the animation packages when asked for
+        import animation
+        os.makedirs(os.path.dirname(args.animation) or ".", exist_ok=True)
+        preview = animation.AnimatedPreview(args.animation, worker=args.animation_worker, fps=args.animation_fps,
+                                            arcs_per_frame=args.arcs_per_frame)
+    else:
+        preview = util.Preview() if show_preview else None
+    try:
+        gcode = generate(params, preview, args.max_depth, args.max_arcs, analytic_arcs=args.analytic_arcs,
+                         chord_tolerance=args.chord_tolerance, gcode_arcs=args.gcode_arcs,
+                         simplify_tolerance=args.simplify_tolerance, cache_dir=args.cache_dir,
+                         cache_max_bytes=int(args.cache_size*2**20), optimize_order=args.optimize_order)
+        timer.lap("generate")
+    finally:
+        # Finish the animation file (and stop its worker process) even if generation failed
+        if args.animation:
+            preview.close()
+            timer.lap("animation")
+
+    # Create a new gcode file
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, 'w') as gcode_file:
+        gcode_file.write(gcode)
+    timer.lap("write_file")
+
+    # Create image
+    if show_preview:
+        preview.render(os.path.splitext(args.output)[0], dpi=600, show=not args.headless)
+        timer.lap("render")
+
+    if args.profile:
+        profiling.stop().write(args.profile)
+
+if __name__ == "__main__":
+    main()
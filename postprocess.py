@@ -0,0 +1,297 @@
+"""
+Replace the bridges in existing slicer gcode with arc overhangs.
+
+Usage:
+    python postprocess.py part.gcode --output part_arcs.gcode
+
+The input is read one line at a time and written out as it goes, so only a single layer is ever
+held in memory and files of hundreds of MB can be processed. Layers are found from the
+;LAYER_CHANGE (PrusaSlicer, SuperSlicer, OrcaSlicer) or ;LAYER: (Cura) comments, and feature
+types from the ;TYPE: comments. In every layer, the extrusions of the overhang feature types
+(by default "Bridge infill") are merged into regions, and each region is filled with arcs
+the same way main.py fills a test part, starting from its longest edge.
+"""
+import argparse
+import re
+import time
+
+from shapely.geometry import LineString
+from shapely.ops import unary_union
+
+import main
+
+LAYER_CHANGE_PREFIXES = (";LAYER_CHANGE", ";LAYER:")
+FEATURE_TYPE_PREFIX = ";TYPE:"
+LAYER_HEIGHT_PREFIX = ";HEIGHT:"
+DEFAULT_OVERHANG_TYPES = ("Bridge infill",)
+
+# Regions smaller than this (mm^2) are left as the slicer made them
+MIN_REGION_AREA = 4
+
+MOVE_PATTERN = re.compile(r"^G[0-3](?:\s|$)")
+WORD_PATTERN = re.compile(r"([XYZEF])\s*(-?\d*\.?\d+)")
+
+class GcodeState:
+    """
+    The parts of the printer state that matter for cutting moves out of a gcode file:
+    where the nozzle is, how much has been extruded and which modes are active.
+    """
+    def __init__(self):
+        self.x = 0.0
+        self.y = 0.0
+        self.e = 0.0
+        self.feedrate = None
+        self.absolute_xy = True
+        self.absolute_e = True
+
+    def copy(self):
+        state = GcodeState()
+        state.__dict__.update(self.__dict__)
+        return state
+
+    def update(self, line):
+        """
+        Apply one line of gcode.
+
+        Returns
+        -------
+        tuple or None
+            (x, y, extruded) for a move, where extruded is the amount of filament pushed out during it, None otherwise
+        """
+        code = line.split(";", 1)[0].strip()
+        if not code:
+            return None
+        if MOVE_PATTERN.match(code):
+            words = dict(WORD_PATTERN.findall(code))
+            if "F" in words:
+                self.feedrate = words["F"]
+            if self.absolute_xy:
+                self.x = float(words.get("X", self.x))
+                self.y = float(words.get("Y", self.y))
+            else:
+                self.x += float(words.get("X", 0))
+                self.y += float(words.get("Y", 0))
+            extruded = 0.0
+            if "E" in words:
+                e = float(words["E"])
+                extruded = e - self.e if self.absolute_e else e
+                self.e = e if self.absolute_e else self.e + e
+            return self.x, self.y, extruded
+        command = code.split()[0]
+        if command == "G90":
+            self.absolute_xy = True
+            self.absolute_e = True
+        elif command == "G91":
+            self.absolute_xy = False
+            self.absolute_e = False
+        elif command == "M82":
+            self.absolute_e = True
+        elif command == "M83":
+            self.absolute_e = False
+        elif command == "G92":
+            words = dict(WORD_PATTERN.findall(code))
+            if "E" in words:
+                self.e = float(words["E"])
+        return None
+
+def overhang_regions(segments, line_width):
+    """
+    Merge the extrusion moves of the overhang features into the regions they cover.
+
+    Parameters
+    ----------
+    segments: list of ((x, y), (x, y))
+        Start and end of every extruding move
+
+    line_width: float
+        Width of the extrusions
+
+    Returns
+    -------
+    list of Polygon
+        The regions, largest first, without the ones smaller than MIN_REGION_AREA
+    """
+    if not segments:
+        return []
+    lines = unary_union([LineString(segment) for segment in segments if segment[0] != segment[1]])
+    # Closing the buffered lines fills the small gaps between neighbouring extrusions
+    covered = lines.buffer(line_width, cap_style=2, join_style=2).buffer(-line_width/2, join_style=2)
+    covered = covered.simplify(line_width/4)
+    return sorted([poly for poly in getattr(covered, 'geoms', [covered]) if poly.area >= MIN_REGION_AREA],
+                  key=lambda poly: -poly.area)
+
+def fill_regions(regions, settings):
+    """
+    Fill overhang regions with arcs.
+
+    Returns
+    -------
+    str
+        The gcode for all regions, using relative extrusion
+    """
+    gcode = []
+    for region in regions:
+        island = main.plan_island(region, settings["n"])
+        gcode.append(main.fill_island(island, settings)["gcode"])
+    return "".join(gcode)
+
+def process_layer(lines, state, settings, overhang_types):
+    """
+    Replace the overhang moves of one layer with arcs.
+
+    Parameters
+    ----------
+    lines: list of str
+        The gcode of the layer
+
+    state: GcodeState
+        The printer state at the start of the layer. Gets updated to the state at the end of the layer.
+
+    settings: dict
+        From main.fill_settings
+
+    overhang_types: collection of str
+        Feature types (from ;TYPE: comments) that get replaced with arcs
+
+    Returns
+    -------
+    list of str
+        The gcode of the layer with the arcs in place of the overhang moves
+    number of regions filled with arcs
+    """
+    start_state = state.copy()
+
+    # First pass: find the overhang blocks (from an overhang ;TYPE: comment to the next ;TYPE: comment
+    # or the end of the layer), and build the regions from their moves
+    in_overhang = False
+    overhang_lines = []
+    overhang_moves = set()
+    segments = []
+    layer_settings = settings
+    for i, line in enumerate(lines):
+        if line.startswith(FEATURE_TYPE_PREFIX):
+            in_overhang = line[len(FEATURE_TYPE_PREFIX):].strip() in overhang_types
+        elif line.startswith(LAYER_HEIGHT_PREFIX):
+            layer_settings = dict(settings, layer_height=float(line[len(LAYER_HEIGHT_PREFIX):]))
+        overhang_lines.append(in_overhang)
+        start = (state.x, state.y)
+        move = state.update(line)
+        if in_overhang and move is not None:
+            overhang_moves.add(i)
+            if move[2] > 0:
+                segments.append((start, move[:2]))
+
+    regions = overhang_regions(segments, settings["line_width"])
+    if not regions:
+        return lines, 0
+    try:
+        arcs = fill_regions(regions, layer_settings)
+    except Exception as error:
+        print("Couldn't fill the overhangs of a layer, leaving it as it was:", error)
+        return lines, 0
+
+    # Second pass: leave out the moves of the overhang blocks (other lines in them, like ;WIDTH: comments, stay),
+    # put the arcs where the first one was, and carry on from where the slicer expects at the end of each block
+    state = start_state
+    travel_feedrate = settings["feedrate"] * 20 * 60
+    output = []
+    inserted = False
+    skipped_moves = False
+    for i, line in enumerate(lines):
+        if i not in overhang_moves:
+            state.update(line)
+            output.append(line)
+        else:
+            if not inserted:
+                output.append(";arc overhang\n")
+                if state.absolute_e:
+                    output.extend(["M83\n", arcs, "M82\n", f"G92 E{state.e:.5f}\n"])
+                else:
+                    output.append(arcs)
+                inserted = True
+            state.update(line)
+            skipped_moves = True
+        block_ends = overhang_lines[i] and (i + 1 == len(lines) or not overhang_lines[i + 1])
+        if block_ends and skipped_moves:
+            # Carry on from where the slicer expects the nozzle and extruder to be
+            output.append(f";arc overhang end\nG0 X{state.x:.3f} Y{state.y:.3f} F{travel_feedrate:g}\n")
+            if state.absolute_e:
+                output.append(f"G92 E{state.e:.5f}\n")
+            if state.feedrate is not None:
+                output.append(f"G1 F{state.feedrate}\n")
+            skipped_moves = False
+    return output, len(regions)
+
+def postprocess(input_file, output_file, params=None, overhang_types=DEFAULT_OVERHANG_TYPES, **options):
+    """
+    Stream a slicer gcode file to output_file, replacing the overhangs of every layer with arcs.
+
+    Parameters
+    ----------
+    input_file, output_file: str
+        Paths of the gcode files
+
+    params: dict, optional
+        Arc settings, keyed by the parameter names in main.label_list. The polygon and tower settings are not used.
+
+    overhang_types: collection of str
+        Feature types (from ;TYPE: comments) to replace with arcs
+
+    options:
+        max_depth, max_arcs, analytic_arcs, chord_tolerance, gcode_arcs, simplify_tolerance, optimize_order, see main.generate
+
+    Returns
+    -------
+    dict
+        Number of layers, layers with arcs, regions filled, and seconds taken
+    """
+    start_time = time.perf_counter()
+    settings = main.fill_settings(main.resolve_params(params or {}), **options)
+    overhang_types = set(overhang_types)
+    state = GcodeState()
+    stats = {"layers": 0, "layers_with_arcs": 0, "regions": 0}
+
+    def write_layer(layer, output):
+        layer, regions = process_layer(layer, state, settings, overhang_types)
+        output.writelines(layer)
+        stats["layers"] += 1
+        stats["layers_with_arcs"] += regions > 0
+        stats["regions"] += regions
+
+    with open(input_file, 'r') as source, open(output_file, 'w') as output:
+        layer = []
+        for line in source:
+            if line.startswith(LAYER_CHANGE_PREFIXES) and layer:
+                write_layer(layer, output)
+                layer = []
+            layer.append(line)
+        write_layer(layer, output)
+    stats["seconds"] = time.perf_counter() - start_time
+    return stats
+
+def main_cli(argv=None):
+    parser = argparse.ArgumentParser(description="Replace the bridges in slicer gcode with arc overhangs")
+    parser.add_argument("input", help="Gcode file from the slicer")
+    parser.add_argument("--output", required=True, help="Where to write the processed gcode")
+    parser.add_argument("--config", help="JSON file with arc settings (same names as main.py)")
+    parser.add_argument("--type", dest="overhang_types", action="append",
+                        help=f"Feature type to replace, can be given more than once (default: {', '.join(DEFAULT_OVERHANG_TYPES)})")
+    parser.add_argument("--analytic-arcs", action="store_true", help="See main.py --analytic-arcs")
+    parser.add_argument("--chord-tolerance", type=main.positive_float, help="See main.py --chord-tolerance")
+    parser.add_argument("--gcode-arcs", action="store_true", help="See main.py --gcode-arcs")
+    parser.add_argument("--simplify-tolerance", type=main.non_negative_float, help="See main.py --simplify-tolerance")
+    parser.add_argument("--optimize-order", action="store_true", help="See main.py --optimize-order")
+    args = parser.parse_args(argv)
+
+    params = main.load_params(args.config, {})
+    stats = postprocess(args.input, args.output, params, args.overhang_types or DEFAULT_OVERHANG_TYPES,
+                        analytic_arcs=args.analytic_arcs, chord_tolerance=args.chord_tolerance,
+                        gcode_arcs=args.gcode_arcs, simplify_tolerance=args.simplify_tolerance,
+                        optimize_order=args.optimize_order)
+    print(f"{stats['regions']} overhang regions in {stats['layers_with_arcs']} of {stats['layers']} layers "
+          f"replaced with arcs in {stats['seconds']:.2f} s -> {args.output}")
+    return 0
+
+if __name__ == "__main__":
+    import sys
+    sys.exit(main_cli())
@@ -0,0 +1,136 @@
+"""
+Opt-in timing of the generation stages and of the hot functions in util.
+
+    profiler = profiling.start()
+    gcode = main.generate(params)
+    profiling.stop().write("profile.json")
+
+or from the command line: python main.py --headless --profile profile.json
+
+Nothing is recorded (and the instrumented functions only pay for one global lookup) unless a
+profiler has been started. Times are inclusive: arc_overhang includes the create_arcs calls made
+from it, and the "fill" stage includes both.
+"""
+import functools
+import json
+import time
+
+import shapely
+
+_active = None
+
+class Profiler:
+    """
+    Call counts and cumulative times of stages and functions. For functions also the total and
+    largest number of vertices of the geometry they worked on (e.g. the remaining empty space).
+    Plus counters of things like the number of arcs.
+    """
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.stages = {}
+        self.functions = {}
+        self.counters = {}
+
+    def add_stage(self, name, seconds, calls=1):
+        entry = self.stages.setdefault(name, {"calls": 0, "seconds": 0.0})
+        entry["calls"] += calls
+        entry["seconds"] += seconds
+
+    def add_function(self, name, seconds, vertices, calls=1, max_vertices=None):
+        entry = self.functions.setdefault(name, {"calls": 0, "seconds": 0.0, "vertices": 0, "max_vertices": 0})
+        entry["calls"] += calls
+        entry["seconds"] += seconds
+        entry["vertices"] += vertices
+        entry["max_vertices"] = max(entry["max_vertices"], vertices if max_vertices is None else max_vertices)
+
+    def add_count(self, name, amount):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def merge(self, report):
+        """Add the numbers from another profiler's report (e.g. from a worker process)"""
+        for name, entry in report["stages"].items():
+            self.add_stage(name, entry["seconds"], entry["calls"])
+        for name, entry in report["functions"].items():
+            self.add_function(name, entry["seconds"], entry["vertices"], entry["calls"], entry["max_vertices"])
+        for name, amount in report["counters"].items():
+            self.add_count(name, amount)
+
+    def report(self):
+        """Everything recorded so far, slowest first"""
+        def by_time(entries):
+            return dict(sorted(entries.items(), key=lambda item: -item[1]["seconds"]))
+        return {"total_seconds": time.perf_counter() - self.start_time,
+                "stages": by_time(self.stages), "functions": by_time(self.functions), "counters": dict(self.counters)}
+
+    def write(self, file_name):
+        """Save the report as JSON"""
+        with open(file_name, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+class Timer:
+    """
+    Times consecutive stages of a function without re-indenting them: each lap() records the time
+    since the timer was made or since the previous lap.
+    """
+    def __init__(self):
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        if _active is not None:
+            _active.add_stage(name, now - self.last)
+        self.last = now
+
+def start():
+    """Start recording. Returns the new Profiler."""
+    global _active
+    _active = Profiler()
+    return _active
+
+def stop():
+    """Stop recording. Returns the Profiler that was active, or None."""
+    global _active
+    profiler, _active = _active, None
+    return profiler
+
+def active():
+    """The Profiler that is recording, or None"""
+    return _active
+
+def count(name, amount=1):
+    """Add to a counter (e.g. the number of arcs printed) while a profiler is active"""
+    if _active is not None:
+        _active.add_count(name, amount)
+
+def num_vertices(geometry):
+    """Number of vertices of a shapely geometry or EmptySpace"""
+    geometry = getattr(geometry, 'polygon', geometry)
+    return int(shapely.get_num_coordinates(geometry)) if geometry is not None else 0
+
+def profiled(name=None, vertices=None):
+    """
+    Decorator that records the calls of a function while a profiler is active.
+
+    Parameters
+    ----------
+    name: str, optional
+        Name in the report. Defaults to the function name.
+
+    vertices: function, optional
+        Called with the function's arguments, returns the number of vertices the call worked on
+    """
+    def decorator(function):
+        label = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            profiler = _active
+            if profiler is None:
+                return function(*args, **kwargs)
+            start_time = time.perf_counter()
+            result = function(*args, **kwargs)
+            seconds = time.perf_counter() - start_time
+            profiler.add_function(label, seconds, vertices(*args, **kwargs) if vertices is not None else 0)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,30 @@
+import argparse
+
+import pytest
+
+import main
+
+@pytest.mark.parametrize("chord_tolerance", [0, -0.1])
+def test_chord_tolerance_must_be_positive(chord_tolerance):
+    with pytest.raises(ValueError, match="chord_tolerance"):
+        main.fill_settings(main.resolve_params({}), chord_tolerance=chord_tolerance)
+    with pytest.raises(ValueError, match="chord_tolerance"):
+        main.generate({}, chord_tolerance=chord_tolerance, seed=1)
+
+@pytest.mark.parametrize("text", ["0", "-0.1", "nan"])
+def test_chord_tolerance_flag_must_be_positive(text):
+    with pytest.raises(argparse.ArgumentTypeError):
+        main.positive_float(text)
+    with pytest.raises(SystemExit):
+        main.parse_args(["--headless", "--chord-tolerance", text])
+
+def test_chord_tolerance_positive():
+    assert main.fill_settings(main.resolve_params({}), chord_tolerance=0.01)["chord_tolerance"] == 0.01
+    assert main.parse_args(["--headless", "--chord-tolerance", "0.01"]).chord_tolerance == 0.01
+
+def test_simplify_tolerance_not_negative():
+    with pytest.raises(ValueError, match="simplify_tolerance"):
+        main.fill_settings(main.resolve_params({}), simplify_tolerance=-0.1)
+    with pytest.raises(SystemExit):
+        main.parse_args(["--headless", "--simplify-tolerance", "-0.1"])
+    assert main.fill_settings(main.resolve_params({}), simplify_tolerance=0)["simplify_tolerance"] == 0
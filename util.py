@@ -2,14 +2,14 @@ import math
 import time
 import random
 import os
+import io
 from typing import List, Tuple
 import shapely
 from shapely.geometry import Point, Polygon, LineString, GeometryCollection
-from shapely import affinity
 from shapely.ops import split, nearest_points
-import geopandas as gpd
-import matplotlib.pyplot as plt
 import numpy as np
+import profiling
+from profiling import profiled, num_vertices
 
 def longest_edge(poly):
     """
@@ -43,6 +43,7 @@ def longest_edge(poly):
 
     return start, end
 
+@profiled(vertices=lambda arc, base_poly, remaining_empty_space: num_vertices(remaining_empty_space))
 def get_farthest_point(arc, base_poly, remaining_empty_space):
     """
     Find the point on a given arc that is farthest away from the base polygon.
@@ -56,8 +57,8 @@ def get_farthest_point(arc, base_poly, remaining_empty_space):
     base_poly: Polygon
         The base polygon
         
-    remaining_empty_space: Polygon
-        The polygon representing the space left to be filled in the base polygon
+    remaining_empty_space: EmptySpace or Polygon
+        The space left to be filled in the base polygon
             
     ax: matplotlib Axes
         Used for plotting
@@ -76,24 +77,29 @@ def get_farthest_point(arc, base_poly, remaining_empty_space):
     point_on_poly: Point
         The point on the base polygon that is closest to the arc
     """
-    longest_distance = 0
-    farthest_point = Point([0, 0])
-
     # Handle input for polygons and LineString
     # The first arc begins on a LineString rather than a Polygon
     if arc.geom_type == 'Polygon':
-        arc_coords = arc.exterior.coords
+        arc_coords = np.asarray(arc.exterior.coords)
     elif arc.geom_type == 'LineString':
         arc_coords = np.linspace(list(arc.coords)[0], list(arc.coords)[1])
     else:
         print('get_farthest_distance: Wrong shape type given')
-        
-    # For every point in the arc, find out which point is farthest away from the base polygon
-    for p in list(arc_coords):
-        distance = Point(p).distance(base_poly)
-        if (distance > longest_distance) and ((remaining_empty_space.buffer(1e-9).contains(Point(p)))):
-            longest_distance = distance
-            farthest_point = Point(p)
+
+    # For every point in the arc at once, find out how far away it is from the base polygon
+    # and whether it is still in the empty space
+    distances = shapely.distance(shapely.points(arc_coords[:, :2]), base_poly)
+    inside = as_empty_space(remaining_empty_space).contains_xy(arc_coords[:, 0], arc_coords[:, 1])
+
+    # Pick the first point with the largest distance, ignoring points that are already filled
+    distances = np.where(inside, distances, 0)
+    i = np.argmax(distances)
+    if distances[i] > 0:
+        longest_distance = float(distances[i])
+        farthest_point = Point(arc_coords[i, :2])
+    else:
+        longest_distance = 0
+        farthest_point = Point([0, 0])
 
     point_on_poly = nearest_points(base_poly, farthest_point)[0]
     return farthest_point, longest_distance, point_on_poly
@@ -138,6 +144,94 @@ def create_circle(x, y, radius, n):
     """
     return Polygon([[radius*np.sin(theta)+x, radius*np.cos(theta)+y] for theta in np.linspace(0, 2*np.pi - 2*np.pi/n, int(n))])
 
+# Fewest segments a circle gets in chord tolerance mode
+MIN_CIRCLE_SEGMENTS = 8
+
+def circle_resolution(radius, n, chord_tolerance=None):
+    """
+    Number of segments to use for a circle.
+
+    Parameters
+    ----------
+    radius: float or array of float
+        Radius of the circle(s)
+
+    n: int
+        Fixed number of segments, used when chord_tolerance is None
+
+    chord_tolerance: float, optional
+        Largest allowed distance (mm) between a segment and the true circle. Small circles get
+        fewer segments and large circles more, instead of the same n for every size.
+
+    Returns
+    -------
+    int, or array of int if radius is an array
+    """
+    if chord_tolerance is None:
+        return np.full(np.shape(radius), int(n)) if np.ndim(radius) else int(n)
+    radius = np.asarray(radius, dtype=float)
+    # A chord spanning an angle of 2*pi/segments is radius*(1 - cos(pi/segments)) from the circle at its middle
+    cos_half_step = np.clip(1 - chord_tolerance/radius, -1, 1)
+    segments = np.ceil(np.pi / np.arccos(cos_half_step))
+    segments = np.maximum(segments, MIN_CIRCLE_SEGMENTS).astype(int)
+    return segments if segments.ndim else int(segments)
+
+def create_circles(x, y, radii, n, angle):
+    """
+    Create a set of concentric circles in one go, as an array of polygons.
+    Gives the same circles as create_circle followed by affinity.rotate(circle, angle, origin='centroid', use_radians=True)
+    for every radius, without building and transforming them one by one.
+
+    Parameters
+    ----------
+    x, y: float
+        Center of the circles
+
+    radii: list of float
+        Radius of every circle
+
+    n: int or array of int
+        Number of segments per circle, either the same for all circles or one per radius (see circle_resolution)
+
+    angle: float
+        Rotation of the circles around their centroid, in radians
+
+    Returns
+    -------
+    numpy array of Polygon
+    """
+    radii = np.asarray(radii, dtype=float)
+    if len(radii) == 0:
+        return np.empty(0, dtype=object)
+    if np.ndim(n):
+        # Circles with the same number of segments are built together
+        n = np.asarray(n)
+        circles = np.empty(len(radii), dtype=object)
+        for segments in np.unique(n):
+            same = n == segments
+            circles[same] = create_circles(x, y, radii[same], int(segments), angle)
+        return circles
+    theta = np.linspace(0, 2*np.pi - 2*np.pi/n, int(n))
+    coords = np.empty((len(radii), int(n), 2))
+    coords[:, :, 0] = radii[:, None]*np.sin(theta) + x
+    coords[:, :, 1] = radii[:, None]*np.cos(theta) + y
+    circles = shapely.polygons(coords)
+
+    # Same rotation as shapely.affinity.rotate, which rotates each circle around its own centroid
+    cosp = math.cos(angle)
+    sinp = math.sin(angle)
+    if abs(cosp) < 2.5e-16:
+        cosp = 0.0
+    if abs(sinp) < 2.5e-16:
+        sinp = 0.0
+    x0, y0 = shapely.get_coordinates(shapely.centroid(circles)).T
+    xoff = x0 - x0*cosp + y0*sinp
+    yoff = y0 - x0*sinp - y0*cosp
+    rings = shapely.get_coordinates(circles).reshape(len(radii), -1, 2)
+    xs, ys = rings[:, :, 0], rings[:, :, 1]
+    rotated = np.stack([cosp*xs - sinp*ys + xoff[:, None], sinp*xs + cosp*ys + yoff[:, None]], axis=-1)
+    return shapely.polygons(rotated)
+
 def create_rect(x, y, length, width, from_center):
     """
     Create a rectangle either from the center or from the bottom-left corner
@@ -174,7 +268,203 @@ def get_exterior(poly):
         for coord in geom.exterior.coords
     ]
 
-def create_arc(circle, remaining_empty_space, ax, depth):
+# Coordinates closer together than this are treated as the same point
+COORDINATE_TOLERANCE = 1e-9
+
+class CoordinateIndex:
+    """
+    A set of coordinates hashed onto a grid, so that checking whether a point is in the set
+    takes constant time, and points that only differ by float noise still count as the same.
+
+    Parameters
+    ----------
+    coords: iterable of (x, y)
+        The coordinates to start with
+
+    tolerance: float
+        Points closer than this (in x and in y) to a coordinate in the set are treated as being in the set
+    """
+    def __init__(self, coords=(), tolerance=COORDINATE_TOLERANCE):
+        self.tolerance = tolerance
+        self.cells = {}
+        for coord in coords:
+            self.add(coord)
+
+    def add(self, coord):
+        # Store the coordinate in every grid cell its tolerance box touches (at most 4, since the cells
+        # are twice the tolerance wide), so a lookup only ever has to check the one cell the point falls in
+        x, y = coord[0], coord[1]
+        cell_size = 2 * self.tolerance
+        for cell_x in range(math.floor((x - self.tolerance) / cell_size), math.floor((x + self.tolerance) / cell_size) + 1):
+            for cell_y in range(math.floor((y - self.tolerance) / cell_size), math.floor((y + self.tolerance) / cell_size) + 1):
+                self.cells.setdefault((cell_x, cell_y), []).append(coord)
+
+    def __contains__(self, coord):
+        cell_size = 2 * self.tolerance
+        cell = (math.floor(coord[0] / cell_size), math.floor(coord[1] / cell_size))
+        for other in self.cells.get(cell, ()):
+            if abs(other[0] - coord[0]) <= self.tolerance and abs(other[1] - coord[1]) <= self.tolerance:
+                return True
+        return False
+
+class FilledShapes:
+    """
+    Registry of the shapes (circles and arcs) that have been filled so far, in an STRtree,
+    so "is this point still empty" is answered with a tree query instead of with the ever more
+    complex remaining empty space polygon.
+
+    The tree can't be added to, so new shapes are kept in a short list that is searched one by
+    one and only merged into a rebuilt tree once it reaches REBUILD_SIZE shapes.
+    add() returns a new FilledShapes, like EmptySpace.difference.
+
+    Parameters
+    ----------
+    base_poly: Polygon
+        The area being filled. Points outside it never count as empty.
+    """
+    REBUILD_SIZE = 32
+
+    def __init__(self, base_poly):
+        # Points on the edge count as inside, like EmptySpace.buffered
+        self.base = base_poly.buffer(COORDINATE_TOLERANCE)
+        shapely.prepare(self.base)
+        self.shapes = np.empty(0, dtype=object)
+        self.tree = None
+        self.recent = ()
+
+    def add(self, shape):
+        """Register a filled shape. Returns a new FilledShapes."""
+        filled = FilledShapes.__new__(FilledShapes)
+        filled.base = self.base
+        # Shrink the shape slightly, so points on its edge still count as empty
+        shrunk = shape.buffer(-COORDINATE_TOLERANCE)
+        shapely.prepare(shrunk)
+        if len(self.recent) + 1 < self.REBUILD_SIZE:
+            filled.shapes, filled.tree, filled.recent = self.shapes, self.tree, self.recent + (shrunk,)
+        else:
+            filled.shapes = np.concatenate([self.shapes, np.array(self.recent + (shrunk,), dtype=object)])
+            filled.tree = shapely.STRtree(filled.shapes)
+            filled.recent = ()
+        return filled
+
+    def __len__(self):
+        return len(self.shapes) + len(self.recent)
+
+    def is_empty(self, x, y):
+        """
+        Which points are inside the base polygon and not inside any filled shape.
+
+        Parameters
+        ----------
+        x, y: arrays of float
+
+        Returns
+        -------
+        bool array
+        """
+        empty = shapely.contains_xy(self.base, x, y)
+        points = shapely.points(x, y)
+        if self.tree is not None:
+            point_index, _ = self.tree.query(points, predicate='within')
+            empty[point_index] = False
+        for shape in self.recent:
+            empty &= ~shapely.contains_xy(shape, x, y)
+        return empty
+
+class EmptySpace:
+    """
+    The space left to be filled in the base polygon, along with the shapes derived from it
+    that get queried over and over while arcs are placed: the prepared polygon, the slightly
+    buffered polygon used for containment checks, and an index of the exterior coordinates.
+
+    The derived shapes are only built when first needed. difference() returns a new EmptySpace,
+    so they never go stale.
+
+    Parameters
+    ----------
+    polygon: Polygon
+        The space left to be filled
+
+    filled: FilledShapes, optional
+        The shapes removed from the base polygon so far. When given, containment checks are
+        answered by it instead of by buffering the polygon, and difference() keeps it up to date.
+
+    simplify_tolerance: float, optional
+        After every difference(), simplify the polygon so its edge moves by at most this much (mm).
+        Every circle subtracted adds up to n vertices, so without this the polygon keeps growing.
+    """
+    def __init__(self, polygon, filled=None, simplify_tolerance=None):
+        self.polygon = polygon
+        self.filled = filled
+        self.simplify_tolerance = simplify_tolerance
+        self._prepared = None
+        self._buffered = None
+        self._exterior_index = None
+        self._segments = None
+
+    @property
+    def prepared(self):
+        """The polygon, prepared for fast intersects/contains queries"""
+        if self._prepared is None:
+            shapely.prepare(self.polygon)
+            self._prepared = self.polygon
+        return self._prepared
+
+    @property
+    def buffered(self):
+        """The polygon grown by 1e-9 (so points on the edge count as inside), prepared"""
+        if self._buffered is None:
+            self._buffered = self.polygon.buffer(1e-9)
+            shapely.prepare(self._buffered)
+        return self._buffered
+
+    @property
+    def exterior_index(self):
+        """CoordinateIndex of the exterior coordinates of the (first) polygon"""
+        if self._exterior_index is None:
+            self._exterior_index = CoordinateIndex(get_exterior(self.polygon))
+        return self._exterior_index
+
+    @property
+    def segments(self):
+        """Start and end points of every edge of the polygon (exterior and holes), as two (m, 2) arrays"""
+        if self._segments is None:
+            starts, ends = [], []
+            for ring in shapely.get_rings(shapely.get_parts(self.polygon)):
+                coords = shapely.get_coordinates(ring)
+                starts.append(coords[:-1])
+                ends.append(coords[1:])
+            if starts:
+                self._segments = (np.concatenate(starts), np.concatenate(ends))
+            else:
+                self._segments = (np.empty((0, 2)), np.empty((0, 2)))
+        return self._segments
+
+    def contains_xy(self, x, y):
+        """Which points are in the empty space, counting points on its edge as inside"""
+        if self.filled is not None:
+            return self.filled.is_empty(x, y)
+        return shapely.contains_xy(self.buffered, x, y)
+
+    def difference(self, other):
+        """Remove a shape from the empty space. Returns a new EmptySpace."""
+        filled = self.filled.add(other) if self.filled is not None else None
+        polygon = self.polygon.difference(other)
+        if self.simplify_tolerance:
+            polygon = polygon.simplify(self.simplify_tolerance, preserve_topology=True)
+        return EmptySpace(polygon, filled, self.simplify_tolerance)
+
+    @property
+    def num_vertices(self):
+        """Number of vertices of the polygon, holes included"""
+        return int(shapely.get_num_coordinates(self.polygon))
+
+def as_empty_space(space):
+    """Wrap a Polygon in an EmptySpace, leaving an EmptySpace untouched"""
+    return space if isinstance(space, EmptySpace) else EmptySpace(space)
+
+@profiled(vertices=lambda circle, remaining_empty_space, *args, **kwargs: num_vertices(remaining_empty_space))
+def create_arc(circle, remaining_empty_space, preview, depth):
     """
     Turns a circle into an arc
     
@@ -183,11 +473,11 @@ def create_arc(circle, remaining_empty_space, ax, depth):
     circle: Polygon
         The circle to convert into an arc
     
-    remaining_empty_space: Polygon
-        The polygon representing the space left to be filled in the base polygon
+    remaining_empty_space: EmptySpace or Polygon
+        The space left to be filled in the base polygon
         
-    ax: matplotlib Axes
-        Used for plotting
+    preview: Preview or None
+        Collects the arc for plotting. Nothing is plotted if this is None.
         
     depth: int
         How deep are we into recursion? Used for rainbow coloring based on depth.
@@ -198,30 +488,104 @@ def create_arc(circle, remaining_empty_space, ax, depth):
         A properly oriented arc shape. (looks like a "D") This will be the path the nozzle takes.
     """
     
+    remaining_empty_space = as_empty_space(remaining_empty_space)
+
+    # Nothing to do if the circle lies completely in the filled area
+    if not shapely.intersects(remaining_empty_space.prepared, circle):
+        print("CIRCLE COMPLETELY ENGULFED")
+        return None
+
     # Turn "moon" shaped arcs into D shapes
-    crescent = circle.intersection(remaining_empty_space)
-    
+    crescent = circle.intersection(remaining_empty_space.polygon)
+    return crescent_to_arc(crescent, remaining_empty_space, preview, depth)
+
+@profiled(vertices=lambda circles, remaining_empty_space, *args, **kwargs: num_vertices(remaining_empty_space))
+def create_arcs(circles, remaining_empty_space, preview, depth):
+    """
+    Turns a set of circles into arcs, like calling create_arc on each of them in turn.
+    All circles are checked against and intersected with the empty space in one vectorized call each.
+
+    Parameters
+    ----------
+    circles: numpy array of Polygon
+        The circles to convert into arcs, e.g. from create_circles
+
+    remaining_empty_space: EmptySpace or Polygon
+        The space left to be filled in the base polygon. The same for all circles.
+
+    preview: Preview or None
+        Collects the arcs for plotting. Nothing is plotted if this is None.
+
+    depth: int
+        How deep are we into recursion? Used for rainbow coloring based on depth.
+
+    Returns
+    -------
+    list of Polygon or None
+        The arc for every circle, None where a circle lies completely in the filled area
+    """
+    remaining_empty_space = as_empty_space(remaining_empty_space)
+
+    circles = np.asarray(circles, dtype=object)
+    hits = shapely.intersects(remaining_empty_space.prepared, circles)
+    crescents = np.full(len(circles), None, dtype=object)
+    crescents[hits] = shapely.intersection(circles[hits], remaining_empty_space.polygon)
+
+    arcs = []
+    for crescent in crescents:
+        if crescent is None:
+            print("CIRCLE COMPLETELY ENGULFED")
+            arcs.append(None)
+        else:
+            arcs.append(crescent_to_arc(crescent, remaining_empty_space, preview, depth))
+    return arcs
+
+def crescent_to_arc(crescent, remaining_empty_space, preview, depth):
+    """
+    Turn the part of a circle that lies in the empty space into a "D" shaped arc. Used by create_arc and create_arcs.
+
+    Parameters
+    ----------
+    crescent: Polygon or MultiPolygon
+        Intersection of the circle with the empty space
+
+    remaining_empty_space: EmptySpace
+        The space left to be filled in the base polygon
+
+    preview: Preview or None
+        Collects the arc for plotting. Nothing is plotted if this is None.
+
+    depth: int
+        Used for rainbow coloring based on depth.
+
+    Returns
+    -------
+    Polygon or None
+        The arc, or None if nothing of the circle is left
+    """
     # Remove all the points in the concave section of the crescent shape, turning it into a "D" shape instead
     crescent_exterior = get_exterior(crescent)
 
-    # Plot the arcs. Comment the following 2 lines to make the code run faster
-    crescent_geoseries = gpd.GeoSeries(Polygon(crescent_exterior))
-    crescent_geoseries.plot(ax=ax[0], color='none', edgecolor='black', linewidth=1) # set color='none' for black and white plotting
-    crescent_geoseries.plot(ax=ax[1], color=num_to_rgb(depth), edgecolor='black', linewidth=1) # set color='none' for black and white plotting
+    # Plot the arcs
+    if preview is not None:
+        preview.add_arc(Polygon(crescent_exterior), depth)
     
-    empty_exterior = get_exterior(remaining_empty_space)
+    # Both lookups are hashed, so this stays linear in the number of vertices
+    empty_exterior = remaining_empty_space.exterior_index
 
     arc = []
+    arc_index = CoordinateIndex()
     for coord in crescent_exterior:
-        if (not coord in empty_exterior) and (not coord in arc):
+        if (not coord in empty_exterior) and (not coord in arc_index):
             arc.append(coord)
+            arc_index.add(coord)
 
     if len(arc) == 0:
         print("CIRCLE COMPLETELY ENGULFED")
         return None
 
     elif len(arc) <= 2:
-        arc = Polygon(crescent_exterior).intersection(remaining_empty_space)
+        arc = Polygon(crescent_exterior).intersection(remaining_empty_space.polygon)
 
     else: 
         arc = Polygon(arc)
@@ -234,108 +598,635 @@ def create_arc(circle, remaining_empty_space, ax, depth):
                 
     return Polygon(fixed_arc) 
 
-def arc_overhang(arc, boundary, starting_line_angle, n, prev_poly, prev_circle, threshold, ax, fig, depth, 
-                 filename_list, r_max, min_arcs, line_width, gcode_file, layer_height, filament_diameter, e_multiplier, feedrate):
-    """ 
-    Main recursive function (I'm deeply sorry for the number of arguments here.)
-    
-    TODO collapse all the hardcoded parameters into a single parameter
-    
+def make_branch_arcs(center, radii, segments, angle, space, preview, depth, analytic=False):
+    """
+    Cut the arcs of a set of concentric circles out of the same empty space.
+
     Parameters
     ----------
-    circle: Polygon
-        The circle to convert into an arc
-    
-    remaining_empty_space: Polygon
-        The polygon representing the space left to be filled in the base polygon
+    center: Point
+        Center of the circles
+
+    radii, segments: list of float, list of int
+        Radius and number of segments of every circle (see circle_resolution)
+
+    angle: float
+        Rotation of the circles, in radians (see create_circles)
+
+    space: EmptySpace
+        The space the arcs are cut from
+
+    preview, depth:
+        See create_arcs
+
+    analytic: bool
+        Use create_arc_analytic instead of polygon intersections
+
+    Returns
+    -------
+    arcs: list
+        The arc of every circle, empty where nothing of the circle is left in the space
+
+    next_circle: Polygon or None
+        The largest circle, None if there are no radii
+    """
+    if analytic:
+        # No circle polygons needed, only the last one gets built below
+        arcs = [create_arc_analytic(center, r, n, angle, space, preview, depth) for r, n in zip(radii, segments)]
+        circles = create_circles(center.x, center.y, radii[-1:], segments[-1:], angle)
+    else:
+        circles = create_circles(center.x, center.y, radii, segments, angle)
+        arcs = create_arcs(circles, space, preview, depth)
+    return arcs, (circles[-1] if len(circles) else None)
+
+def create_branch(next_point, r_final, prev_poly, prev_circle, depth, settings, toolpath, preview):
+    """
+    Print one branch: a set of concentric arcs growing out from next_point until they reach r_final.
+
+    Parameters
+    ----------
+    next_point: Point
+        Center of the arcs, on the arc that this branch is built on
         
-    ax: matplotlib Axes
-        Used for plotting
+    r_final: float
+        Distance from next_point to the boundary
+        
+    prev_poly: EmptySpace
+        The space left to be filled in the base polygon
+        
+    prev_circle: Polygon or None
+        The largest circle of the branch this one is built on
         
     depth: int
-        How deep are we into recursion? Used for rainbow coloring based on depth.
+        How many branches deep this one is. Used for rainbow coloring based on depth.
+        
+    settings: dict
+        See arc_overhang
+        
+    toolpath: Toolpath
+        Where the arcs are added
+        
+    preview: Preview or None
+        Collects the arcs for plotting. Nothing is plotted if this is None.
+        
+    Returns
+    -------
+    curr_arc: Polygon or None
+        The outermost arc of the branch, which the next branches get built on. None if no arc could be made.
+        
+    next_circle: Polygon or None
+        The outermost circle of the branch
+        
+    remaining_empty_space: EmptySpace
+        The space left to be filled after this branch
+        
+    num_arcs: int
+        How many arcs were printed
     """
-    # Find the next center point of arc, the radius of the new arc, and the closest point on the boundary to the center point.
-    next_point, r_final, _ = get_farthest_point(arc, boundary, prev_poly)
+    line_width = settings["line_width"]
+
     # Limit maximum circle size
-    r_final = min(r_final - threshold, r_max)
+    r_final = min(r_final - settings["threshold"], settings["r_max"])
 
     small_arc_radius = 0.5  #1
 
     # Overlap arc with the previous one. 
     circle_moved = False
-    if r_final > small_arc_radius:
+    if r_final > small_arc_radius and prev_circle is not None:
         next_point = move_toward_point(next_point, prev_circle.centroid, 0) # change 0 to any distance in mm to move the arcs 
         circle_moved = True
     
     # Update the current boundary polygon to include the previous circle
-    remaining_empty_space = prev_poly.difference(prev_circle)    
+    remaining_empty_space = prev_poly.difference(prev_circle) if prev_circle is not None else prev_poly
     
     # Create multiple layers  
     r = line_width
     if r > r_final:
         print("WARNING: r", r, "should not be bigger than r_final", r_final)
-        
+    radii = []
     while r < r_final:
-        # Create a circle based on point location, radius, n
-        next_circle = create_circle(next_point.x, next_point.y, r, n)
-        next_circle = affinity.rotate(next_circle, starting_line_angle, origin = 'centroid', use_radians=True)
-      
-        # Plot arc
-        next_arc = create_arc(next_circle, remaining_empty_space, ax, depth)
+        radii.append(r)
+        r += line_width
+
+    segments = circle_resolution(radii, settings["n"], settings.get("chord_tolerance"))
+
+    # All the arcs of the branch are cut from the same empty space, so they can be made in one go
+    arcs, next_circle = make_branch_arcs(next_point, radii, segments, settings["starting_line_angle"],
+                                         remaining_empty_space, preview, depth, settings.get("analytic_arcs"))
+        
+    curr_arc = None
+    num_arcs = 0
+    for r, n, next_arc in zip(radii, segments, arcs):
         if not next_arc:
-            r += line_width
             continue
         curr_arc = Polygon(next_arc)
-        longest_distance = r
         
         #Slow down and reduce flow for all small arcs
         if circle_moved and r < small_arc_radius:
-            speed_modifier = 0.25
-            e_modifier = 0.25
+            modifier = SMALL_ARC
         elif r <= line_width:
-            speed_modifier = 0.25
-            e_modifier = 0.1
+            modifier = INNERMOST_ARC
         else: 
-            speed_modifier = 1
-            e_modifier = 1
+            modifier = FULL_SPEED
 
-        # Write gcode
+        # Add it to the toolpath
         if r_final > 0:    
-            write_gcode(gcode_file, next_arc, line_width, layer_height, filament_diameter, e_multiplier*e_modifier, feedrate*speed_modifier, False)
+            toolpath.add(next_arc, False, depth, (next_point.x, next_point.y, r, n), modifier)
+            num_arcs += 1
+
+    if next_circle is not None:
+        remaining_empty_space = remaining_empty_space.difference(next_circle)
+    return curr_arc, next_circle, remaining_empty_space, num_arcs
+
+@profiled(vertices=lambda center, r, n, angle, remaining_empty_space, *args, **kwargs: num_vertices(remaining_empty_space))
+def create_arc_analytic(center, r, n, angle, remaining_empty_space, preview, depth):
+    """
+    Create the arc of a circle that lies in the remaining empty space without any polygon booleans.
+
+    Instead of intersecting an n-gon with the empty space, the true circle is intersected with every
+    edge of the empty space in closed form. That splits the circle into angular intervals, and a single
+    containment test per interval says whether it is still empty. Only the empty intervals are sampled,
+    at the same angles as the vertices of create_circle(x, y, r, n) rotated by angle.
+    The result is the same "D" shape path as create_arc, except that the ends of the arc lie exactly
+    on the circle rather than on the n-gon.
+    
+    Parameters
+    ----------
+    center: Point
+        Center of the circle
         
-        r += line_width
-        # Create image
-        #filename = image_number(filename_list)   
-        #plt.savefig(filename, dpi=200)
-        #filename_list.append(filename + ".png")
+    r: float
+        Radius of the circle
+        
+    n: int
+        Points per circle
         
-    remaining_empty_space = remaining_empty_space.difference(next_circle)
+    angle: float
+        Rotation of the circle in radians (the starting line angle)
     
-    next_point, longest_distance, _ = get_farthest_point(curr_arc, boundary, remaining_empty_space)
-    branch = 0    
-    # Create new arcs on the same base arc until no more points on the base arc are farther than the threshold distance.
-    while (longest_distance > threshold + min_arcs*line_width): 
-        branch += 1
+    remaining_empty_space: EmptySpace or Polygon
+        The space left to be filled in the base polygon
+        
+    preview: Preview or None
+        Collects the arc for plotting. Nothing is plotted if this is None.
+        
+    depth: int
+        How deep are we into recursion? Used for rainbow coloring based on depth.
+        
+    Returns
+    -------
+    Polygon or None
+        A properly oriented arc shape, like create_arc. None if no part of the circle is empty.
+    """
+    remaining_empty_space = as_empty_space(remaining_empty_space)
+    cx, cy = center.x, center.y
+    n = int(n)
+    step = 2*np.pi/n
+
+    # Where does the circle cross the edges of the empty space? Solve |a + t*(b - a) - c| = r for 0 <= t <= 1
+    starts, ends = remaining_empty_space.segments
+    d = ends - starts
+    f = starts - (cx, cy)
+    qa = np.einsum('ij,ij->i', d, d)
+    qb = 2*np.einsum('ij,ij->i', f, d)
+    qc = np.einsum('ij,ij->i', f, f) - r*r
+    discriminant = qb*qb - 4*qa*qc
+    hit = (discriminant >= 0) & (qa > 0)
+    root = np.sqrt(discriminant[hit])
+    t = np.concatenate([(-qb[hit] - root)/(2*qa[hit]), (-qb[hit] + root)/(2*qa[hit])])
+    segment = np.concatenate([np.flatnonzero(hit)]*2)
+    on_segment = (t >= 0) & (t <= 1)
+    crossings = starts[segment[on_segment]] + t[on_segment, None]*d[segment[on_segment]]
+    crossing_angles = np.unique(np.mod(np.arctan2(crossings[:, 1] - cy, crossings[:, 0] - cx), 2*np.pi))
+
+    # Split the circle at the crossings, and check the middle of every piece to see if it's still empty
+    if len(crossing_angles) == 0:
+        crossing_angles = np.array([0.0])
+    interval_starts = crossing_angles
+    interval_ends = np.append(crossing_angles[1:], crossing_angles[0] + 2*np.pi)
+    middles = (interval_starts + interval_ends)/2
+    empty = shapely.contains_xy(remaining_empty_space.prepared, cx + r*np.cos(middles), cy + r*np.sin(middles))
+    if not empty.any():
+        print("CIRCLE COMPLETELY ENGULFED")
+        return None
+
+    # Sample the empty pieces at the circle's vertex angles, plus the exact points where they end
+    base_angle = np.mod(angle + np.pi/2, step)
+    angles = []
+    for lo, hi in zip(interval_starts[empty], interval_ends[empty]):
+        vertex_angles = base_angle + step*np.arange(np.ceil((lo - base_angle)/step), np.floor((hi - base_angle)/step) + 1)
+        vertex_angles = vertex_angles[(vertex_angles - lo > 1e-9) & (hi - vertex_angles > 1e-9)]
+        if hi - lo >= 2*np.pi:
+            # The whole circle is empty
+            angles.append(vertex_angles)
+        else:
+            angles.append(np.concatenate([[lo], vertex_angles, [hi]]))
+    # Go around clockwise, like the vertices of create_circle
+    angles = np.concatenate(angles)[::-1]
+    arc = np.column_stack([cx + r*np.cos(angles), cy + r*np.sin(angles)])
+    arc = arc[np.append(True, np.any(np.abs(np.diff(arc, axis=0)) > COORDINATE_TOLERANCE, axis=1))]
+    if len(arc) < 3:
+        print("CIRCLE COMPLETELY ENGULFED")
+        return None
 
-        #Create a new arc on curr_arc
-        next_arc, remaining_empty_space, filename_list = arc_overhang(
-            curr_arc, boundary, starting_line_angle, n, remaining_empty_space, next_circle, threshold, ax, fig, depth + 1, 
-            filename_list, r_max, min_arcs, line_width, gcode_file, layer_height, filament_diameter, e_multiplier, feedrate)
+    # Make sure first point is on one corner "D", and last point is on the other. 
+    # This makes sure the arcs start from one end, and go all the away around to the other.
+    # Same as longest_edge + get_boundary_line, on the coordinate array.
+    edges = np.roll(arc, -1, axis=0) - arc
+    longest = np.argmax(edges[:, 0]*edges[:, 0] + edges[:, 1]*edges[:, 1])
+    fixed_arc = Polygon(np.roll(arc, -(longest + 1), axis=0))
+
+    # Plot the arcs
+    if preview is not None:
+        preview.add_arc(fixed_arc, depth)
+                
+    return fixed_arc
+
+@profiled(vertices=lambda arc, boundary, remaining_empty_space, *args, **kwargs: num_vertices(remaining_empty_space))
+def arc_overhang(arc, boundary, remaining_empty_space, prev_circle, settings, toolpath, preview=None):
+    """ 
+    Main filling function. Builds branches of arcs on top of arc, then more branches on top of those,
+    until the space is filled.
+    
+    Branches are grown depth-first using an explicit stack instead of recursion, so deep trees don't
+    run into Python's recursion limit and the amount of work per part can be capped.
+    The arcs come out in the same order as the old recursive version.
+    
+    Parameters
+    ----------
+    arc: Polygon
+        The arc to start building on
+        
+    boundary: LineString
+        The edge of the base polygon that arcs build out towards
+        
+    remaining_empty_space: EmptySpace
+        The space left to be filled in the base polygon
+        
+    prev_circle: Polygon or None
+        The circle that arc was made from
+        
+    settings: dict
+        line_width: width of the arcs
+        n: points per circle
+        r_max: largest allowed circle radius
+        threshold: how much of a 'buffer' the arcs leave around the base polygon
+        min_arcs: smallest number of arcs a branch needs for it to be printed
+        starting_line_angle: rotation of the circles, in radians
+        max_depth (optional): don't grow branches deeper than this
+        max_arcs (optional): stop starting new branches once this many arcs have been printed
+            (a branch that printed no arcs counts as one)
+        simplify_tolerance (optional): read by main.fill_island, see EmptySpace
+        analytic_arcs (optional): use create_arc_analytic instead of create_arc
+        chord_tolerance (optional): pick the points per circle from the radius instead of using n, see circle_resolution
+        The print settings (layer_height, feedrate, ...) are only used by emit_toolpath.
+        
+    toolpath: Toolpath
+        Where the arcs are added. See emit_toolpath for turning them into gcode.
+        
+    preview: Preview or None
+        Collects the arcs for plotting. Nothing is plotted if this is None.
+        
+    Returns
+    -------
+    remaining_empty_space: EmptySpace
+        The space that is still empty after filling
+        
+    branches: list of dict
+        depth, number of arcs, time taken and the number of vertices of the remaining empty space
+        afterwards for every branch, in the order they were printed
+    """
+    min_distance = settings["threshold"] + settings["min_arcs"]*settings["line_width"]
+    max_depth = settings.get("max_depth")
+    max_arcs = settings.get("max_arcs")
+
+    branches = []
+    total_arcs = 0
+    # Each entry is a branch that may still get new branches built on it: [arc, circle, depth, number of branches so far]
+    stack = [[arc, prev_circle, 0, 0]]
+    while stack:
+        frame = stack[-1]
+        curr_arc, curr_circle, depth, num_branches = frame
 
         # Get the farthest distance between curr_arc and the boundary
-        next_point, longest_distance, closest_point_on_poly = get_farthest_point(
-            curr_arc, boundary, remaining_empty_space)
+        next_point, longest_distance, _ = get_farthest_point(curr_arc, boundary, remaining_empty_space)
+
+        # Create new arcs on the same base arc until no more points on the base arc are farther than the threshold distance.
+        out_of_budget = ((max_depth is not None and depth >= max_depth)
+                         or (max_arcs is not None and total_arcs >= max_arcs))
+        if longest_distance > min_distance and not out_of_budget:
+            frame[3] += 1
+            start_time = time.perf_counter()
+            next_arc, next_circle, remaining_empty_space, num_arcs = create_branch(
+                next_point, longest_distance, remaining_empty_space, curr_circle, depth + 1, settings, toolpath, preview)
+            # A branch that printed nothing still counts as one towards max_arcs, so attempts can't go on forever
+            total_arcs += max(num_arcs, 1)
+            profiling.count("arcs", num_arcs)
+            profiling.count("branches")
+            branches.append({"depth": depth + 1, "arcs": num_arcs, "seconds": time.perf_counter() - start_time,
+                             "vertices": remaining_empty_space.num_vertices})
+            if next_circle is None:
+                # Not even the smallest circle fits at the farthest point (r_min or r_max below the line width).
+                # Nothing changed, so the same point would come up again: this arc is done.
+                stack.pop()
+            elif next_arc is not None:
+                stack.append([next_arc, next_circle, depth + 1, 0])
+        else:
+            stack.pop()
+            if depth > 0:
+                print("Depth = ", depth, "Arcs this layer", num_branches)
+
+    return remaining_empty_space, branches
+
+def nearest_neighbour_order(starts, ends, position):
+    """
+    Order a set of paths so that each one starts as close as possible to where the previous one ended.
+    Greedy: always goes to the closest path that hasn't been visited yet.
+
+    Parameters
+    ----------
+    starts: list of (x, y)
+        Where each path starts. None if the path is empty.
+
+    ends: list of (x, y)
+        Where each path ends. None if the path is empty.
+
+    position: (x, y)
+        Where the nozzle is before the first path
+
+    Returns
+    -------
+    list of int
+        Indexes of the paths in the order they should be printed
+    """
+    order = []
+    unvisited = list(range(len(starts)))
+    while unvisited:
+        def travel(i):
+            if starts[i] is None or position is None:
+                return 0
+            return math.dist(position, starts[i])
+        closest = min(unvisited, key=travel)
+        unvisited.remove(closest)
+        order.append(closest)
+        if ends[closest] is not None:
+            position = ends[closest]
+    return order
+
+def perimeter_rings(boundary_poly, remaining_empty_space, line_width, max_rings=100):
+    """
+    Concentric rings inside the edge of the base polygon, clipped to the space the arcs didn't fill.
+
+    Ring i sits line_width*(max_rings - 1 - i) inside the edge. The offsets are worked out from the
+    edge inwards and stop at the first one that leaves nothing of the polygon (i.e. past its inscribed
+    radius), and rings that miss the empty space are skipped with a prepared intersects check
+    before doing the actual intersection.
+
+    Parameters
+    ----------
+    boundary_poly: Polygon
+        The base polygon
+        
+    remaining_empty_space: EmptySpace or Polygon
+        The space left to be filled in the base polygon
+        
+    line_width: float
+        Distance between rings
+        
+    max_rings: int
+        Most rings to print
         
-        # Optional: Draw lines showing distance to outer polygon
-        #if list(next_point.coords)[0] != (0,0):
-        #    nextPointGeoSeries = gpd.GeoSeries(LineString([next_point, closest_point_on_poly]))
-        #    nextPointGeoSeries.plot(ax=ax[0], color='green', linewidth=1)
+    Returns
+    -------
+    list of LineString
+        The pieces of the rings, innermost ring first
+    """
+    remaining_empty_space = as_empty_space(remaining_empty_space)
+
+    rings = []
+    for i in reversed(range(max_rings)):
+        offset_poly = boundary_poly.buffer(-(max_rings - 1)*line_width + line_width*i)
+        if offset_poly.is_empty:
+            # Every ring further in would be empty too
+            break
+
+        ring_pieces = []
+        for poly in getattr(offset_poly, 'geoms', [offset_poly]):
+            ring = LineString(poly.exterior.coords)
+            if not shapely.intersects(remaining_empty_space.prepared, ring):
+                continue
+            ring = ring.intersection(remaining_empty_space.polygon)
+            if ring.length < 1e-9:
+                continue
+            ring_pieces += [line for line in getattr(ring, 'geoms', [ring]) if line.geom_type == 'LineString']
+        rings.append(ring_pieces)
+
+    return [line for ring_pieces in reversed(rings) for line in ring_pieces]
+
+class GcodeWriter:
+    """
+    Collects all the gcode for a run in memory, instead of reopening the output file for every arc.
+    getvalue() returns it, and the caller writes it to disk in one go.
+    """
+    def __init__(self):
+        self.buffer = io.StringIO()
+        # XY of the first and the most recent move written with write_moves
+        self.first_position = None
+        self.last_position = None
+
+    def write(self, text):
+        """Add raw gcode text to the buffer"""
+        self.buffer.write(text)
+
+    def write_file(self, file_name):
+        """Copy the contents of another file (e.g. start or end gcode) into the buffer"""
+        with open(file_name, 'r') as input_file:
+            self.buffer.write(input_file.read())
+
+    def write_z(self, z, feedrate=500):
+        """Move the nozzle to height z"""
+        self.buffer.write(f"G1 Z{'{0:.3f}'.format(z)} F{feedrate}\n")
+
+    def write_moves(self, coords, e_distances, feedrates, retract, deretract, offsets=None, clockwise=None):
+        """
+        Format a batch of moves with a single string operation.
+
+        Parameters
+        ----------
+        coords: array of shape (n, 2)
+            XY coordinates of every move
+
+        e_distances: array of shape (n,)
+            Amount of filament extruded during each move
 
-    print("Depth = ", depth, "Arcs this layer", branch)
-    return next_arc, remaining_empty_space, filename_list
+        feedrates: array of shape (n,)
+            Feedrate of each move in mm/s
+
+        retract: bool array of shape (n,)
+            Moves that get a retraction before them
+
+        deretract: bool array of shape (n,)
+            Moves that get a deretraction after them
+
+        offsets: array of shape (n, 2), optional
+            I and J (center of the circle relative to where the move starts) for moves that are
+            printed as G2/G3 arcs, NaN for straight moves
+
+        clockwise: bool array of shape (n,), optional
+            Arc moves that go clockwise (G2) instead of counter-clockwise (G3)
+        """
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        if len(coords) == 0:
+            return
+        if self.first_position is None:
+            self.first_position = tuple(coords[0].tolist())
+        self.last_position = tuple(coords[-1].tolist())
+        templates = np.where(retract, "G1 E-1 F1500\nG0 X%.3f Y%.3f E%.8f F%s\n", "G0 X%.3f Y%.3f E%.8f F%s\n")
+        templates = np.char.add(templates, np.where(deretract, "G1 E1 F1500\n", ""))
+        values = np.column_stack([coords, e_distances, np.asarray(feedrates, dtype=float) * 60])
+        if offsets is not None:
+            is_arc = ~np.isnan(offsets[:, 0])
+            arc_templates = np.where(clockwise, "G2 X%.3f Y%.3f I%.3f J%.3f E%.8f F%s\n",
+                                     "G3 X%.3f Y%.3f I%.3f J%.3f E%.8f F%s\n")
+            templates = np.where(is_arc, arc_templates, templates)
+            # Straight moves have no I and J, so leave those values out
+            values = np.column_stack([coords, offsets, values[:, 2:]])
+            keep = np.ones(values.shape, dtype=bool)
+            keep[:, 2:4] = is_arc[:, None]
+            values = values[keep]
+        self.buffer.write("".join(templates.tolist()) % tuple(values.ravel().tolist()))
+
+    def getvalue(self):
+        """Return all the gcode written so far"""
+        return self.buffer.getvalue()
+
+def merge_circle_moves(coords, e_distances, circle):
+    """
+    Find runs of moves that follow a circle, and turn each run into a single G2/G3 arc move.
+
+    Parameters
+    ----------
+    coords: array of shape (n, 2)
+        XY coordinates of every move
+
+    e_distances: array of shape (n,)
+        Amount of filament extruded during each move
+
+    circle: tuple
+        (x, y, radius, number of segments) of the circle the moves were cut from
+
+    Returns
+    -------
+    coords, e_distances: arrays
+        The moves that are left. A merged run ends where its last move ended and extrudes as much as all of them.
+
+    offsets: array of shape (m, 2)
+        I and J of every arc move, NaN for straight moves
+
+    clockwise: bool array of shape (m,)
+        Arc moves that go clockwise
+    """
+    x, y, radius, n = circle
+    step = 2*np.pi/n
+    relative = coords - (x, y)
+    distances = np.sqrt(relative[:, 0]*relative[:, 0] + relative[:, 1]*relative[:, 1])
+    # Vertices of the circle lie on it, where it was cut they lie on one of its chords
+    on_circle = (distances <= radius + 1e-6) & (distances >= radius*np.cos(step/2) - 1e-6)
+    angles = np.arctan2(relative[:, 1], relative[:, 0])
+    sweeps = np.diff(angles, prepend=angles[:1])
+    sweeps = (sweeps + np.pi) % (2*np.pi) - np.pi
+
+    # A move follows the circle if it is no longer than one segment. Longer moves jump across space that is already filled.
+    follows = on_circle & np.roll(on_circle, 1) & (np.abs(sweeps) <= step*(1 + 1e-6)) & (e_distances > 0.0001)
+    follows[0] = False
+    clockwise = sweeps < 0
+
+    # Every move starts a new group, except one that carries on along the circle in the same direction
+    new_group = np.ones(len(coords), dtype=bool)
+    new_group[1:] = ~(follows[1:] & follows[:-1] & (clockwise[1:] == clockwise[:-1]))
+    starts = np.nonzero(new_group)[0]
+    ends = np.append(starts[1:] - 1, len(coords) - 1)
+
+    is_arc = follows[starts]
+    offsets = np.full((len(starts), 2), np.nan)
+    offsets[is_arc] = (x, y) - coords[starts[is_arc] - 1]
+    return coords[ends], np.add.reduceat(e_distances, starts), offsets, clockwise[starts]
+
+def path_coords(arc, close_loop):
+    """
+    The coordinates a polygon or line is printed along, without repeated points.
+
+    Parameters
+    ----------
+    arc: Polygon, LineString or a collection of them
+        Only the first polygon is used if there are several
+
+    close_loop: bool
+        Go all the way around a polygon back to its first point
+
+    Returns
+    -------
+    array of shape (n, 2)
+    """
+    #extract just the first polygon if there's ever a multipolygon or geometry collection
+    for geom in getattr(arc, 'geoms', [arc]):
+        if geom.geom_type == 'Polygon':
+            arc = geom
+            break
+
+    for geom in getattr(arc, 'geoms', [arc]):
+        if geom.geom_type == 'LineString':
+            coord_list = arc.coords
+
+        elif geom.geom_type == 'Polygon':
+            if close_loop == False:
+                coord_list = arc.exterior.coords[:-1]
+            else:
+                coord_list = arc.exterior.coords
+
+    if len(coord_list) == 0:
+        return np.empty((0, 2))
+
+    # Drop repeated coordinates, since they would just be zero length moves
+    coords = np.asarray(coord_list, dtype=float)[:, :2]
+    keep = np.ones(len(coords), dtype=bool)
+    keep[1:] = np.any(coords[1:] != coords[:-1], axis=1)
+    return coords[keep]
+
+def extrusion(distances, line_width, layer_height, filament_diameter, e_multiplier):
+    """
+    Extrusion number = height of cylinder with equal volume to amount of filament required
+    to print lines of the given lengths. e_multiplier can be one number or one per line.
+    """
+    volumes = line_width * layer_height * distances
+    return e_multiplier * volumes / (3.1415 * (filament_diameter / 2)**2)
+
+def move_extrusion(coords, starts, line_width, layer_height, filament_diameter, e_multiplier):
+    """
+    Extrusion of every move along one or more paths stored one after the other in coords.
+    The moves at the indices in starts begin a new path, so they have no length and extrude nothing.
+    e_multiplier can be one number or one per move.
+    """
+    deltas = np.diff(coords, axis=0, prepend=coords[:1])
+    deltas[starts] = 0
+    distances = np.sqrt(deltas[:, 0]*deltas[:, 0] + deltas[:, 1]*deltas[:, 1])
+    return extrusion(distances, line_width, layer_height, filament_diameter, e_multiplier)
 
-def write_gcode(file_name, arc, line_width, layer_height, filament_diameter, e_multiplier, feedrate, close_loop):
+def write_extruded_moves(gcode_writer, coords, e_distances, feedrate, short_travel=False, offsets=None, clockwise=None):
+    """
+    Write moves with the extrusion from move_extrusion. Moves that don't extrude anything are
+    travel moves, sped up and with a retraction around them unless they are in short_travel.
+    feedrate and short_travel can be one value or one per move, see GcodeWriter.write_moves for the rest.
+    """
+    kept = ~np.asarray(short_travel, dtype=bool)
+    travel = e_distances <= 0.0001
+    retract = travel & kept
+    deretract = (e_distances <= 0.000001) & kept
+    feedrates = np.where(travel, feedrate * 20, feedrate)
+    gcode_writer.write_moves(coords, e_distances, feedrates, retract, deretract, offsets, clockwise)
+
+@profiled(vertices=lambda gcode_writer, arc, *args, **kwargs: num_vertices(arc))
+def write_gcode(gcode_writer, arc, line_width, layer_height, filament_diameter, e_multiplier, feedrate, close_loop):
     ## TODO try using circles instead of D shapes for better surface quality
     ## TODO use a dict or something to reduce # parameters
     #line_width = print_settings["line_width"]
@@ -343,58 +1234,400 @@ def write_gcode(file_name, arc, line_width, layer_height, filament_diameter, e_m
     #e_multiplier = print_settings["e_multiplier"]
     #filament_diameter = print_settings["filament_diameter"]
     #feedrate = print_settings["feedrate"]    
-    feedrate_travel = feedrate * 20
-    feedrate_printing = feedrate
+    coords = path_coords(arc, close_loop)
+    if len(coords) == 0:
+        return
 
-    #extract just the first polygon if there's ever a multipolygon or geometry collection
-    for geom in getattr(arc, 'geoms', [arc]):
-        if geom.geom_type == 'Polygon':
-            arc = geom
-            break
+    # Calculate extrusion amount for every segment at once
+    e_distances = move_extrusion(coords, [0], line_width, layer_height, filament_diameter, e_multiplier)
+    write_extruded_moves(gcode_writer, coords, e_distances, feedrate)
+    return
 
-    with open(file_name, 'a') as gcode_file:
-        
-        for geom in getattr(arc, 'geoms', [arc]):
-            if geom.geom_type == 'LineString':
-                coord_list = arc.coords
+# Speed and flow modifier codes of the paths in a Toolpath, and the (speed, flow) multipliers they stand for
+FULL_SPEED = 0
+SMALL_ARC = 1       # Arcs smaller than 0.5 mm: slowed down, less flow
+INNERMOST_ARC = 2   # The first arc of a branch: slowed down, a lot less flow
+MODIFIERS = np.array([[1, 1], [0.25, 0.25], [0.25, 0.1]])
 
-            elif geom.geom_type == 'Polygon':
-                if close_loop == False:
-                    coord_list = arc.exterior.coords[:-1]
-                else:
-                    coord_list = arc.exterior.coords
+class Toolpath:
+    """
+    The paths of a fill, kept as geometry only so they can be turned into gcode later with any
+    flow and speed settings (see emit_toolpath). All paths share one flat coordinate buffer.
 
-        first_coord = True    
-        prev_coordinate = coord_list[0]
-        for coordinate in coord_list:
-            if not first_coord and coordinate == prev_coordinate:
-                continue
-            else: 
-                first_coord = False
-            # Calculate extrusion amount
-            # Extrusion number = height of cylinder with equal volume to amount of filament required
-            distance = Point(coordinate).distance(Point(prev_coordinate))
-            volume = line_width * layer_height * distance
-            e_distance = e_multiplier * volume / (3.1415 * (filament_diameter / 2)**2)
-
-            if e_distance <= 0.0001:
-                feedrate = feedrate_travel
-                gcode_file.write("G1 E-1 F1500\n") # retract
+    Parameters
+    ----------
+    coords: array of shape (n, 2)
+        The points of every path, one path after the other
+
+    offsets: array of shape (m + 1,)
+        Path i is coords[offsets[i]:offsets[i + 1]]
+
+    depth: array of shape (m,)
+        Depth of the branch every path belongs to, 0 for the first arcs and -1 for perimeter rings
+
+    circles: array of shape (m, 4)
+        x, y, radius and points per circle of the circle every arc was cut from, NaN for other paths
+
+    modifiers: array of shape (m,)
+        Speed and flow modifier code of every path (FULL_SPEED, SMALL_ARC or INNERMOST_ARC)
+
+    Paths are added one at a time with add() while the fill is made, and joined into the arrays
+    the first time the arrays are read.
+    """
+    def __init__(self, coords=None, offsets=None, depth=None, circles=None, modifiers=None):
+        self._coords = np.empty((0, 2)) if coords is None else np.asarray(coords, dtype=float)
+        self._offsets = np.zeros(1, dtype=np.int64) if offsets is None else np.asarray(offsets, dtype=np.int64)
+        self._depth = np.empty(0, dtype=np.int32) if depth is None else np.asarray(depth, dtype=np.int32)
+        self._circles = np.empty((0, 4)) if circles is None else np.asarray(circles, dtype=float)
+        self._modifiers = np.empty(0, dtype=np.uint8) if modifiers is None else np.asarray(modifiers, dtype=np.uint8)
+        self._pending = []
+
+    def add(self, arc, close_loop=False, depth=-1, circle=None, modifier=FULL_SPEED):
+        """
+        Add the path along a polygon or line, see path_coords.
+        circle is (x, y, radius, points per circle) of the circle an arc was cut from.
+        """
+        coords = path_coords(arc, close_loop)
+        if len(coords):
+            self._pending.append((coords, depth, circle if circle is not None else (np.nan,)*4, modifier))
+
+    def _join(self):
+        if not self._pending:
+            return
+        coords, depth, circles, modifiers = zip(*self._pending)
+        self._pending = []
+        sizes = np.cumsum([len(path) for path in coords]) + self._offsets[-1]
+        self._coords = np.concatenate([self._coords, *coords])
+        self._offsets = np.append(self._offsets, sizes)
+        self._depth = np.append(self._depth, np.array(depth, dtype=np.int32))
+        self._circles = np.concatenate([self._circles, np.array(circles, dtype=float)])
+        self._modifiers = np.append(self._modifiers, np.array(modifiers, dtype=np.uint8))
+
+    @property
+    def coords(self):
+        self._join()
+        return self._coords
+
+    @property
+    def offsets(self):
+        self._join()
+        return self._offsets
+
+    @property
+    def depth(self):
+        self._join()
+        return self._depth
+
+    @property
+    def circles(self):
+        self._join()
+        return self._circles
+
+    @property
+    def modifiers(self):
+        self._join()
+        return self._modifiers
+
+    @property
+    def radius(self):
+        """Radius of the circle every arc was cut from, NaN for other paths"""
+        return self.circles[:, 2]
+
+    def __len__(self):
+        """Number of paths"""
+        return len(self.offsets) - 1
+
+    def path(self, i):
+        """The coordinates of path i"""
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+    def translate(self, dx, dy):
+        """The same toolpath moved by dx, dy"""
+        return Toolpath(self.coords + (dx, dy), self.offsets, self.depth,
+                        np.column_stack([self.circles[:, :2] + (dx, dy), self.circles[:, 2:]]), self.modifiers)
+
+    def save(self, file_name, **extra):
+        """Write the toolpath to a .npz file (a path or an open binary file), along with any extra arrays"""
+        np.savez(file_name, coords=self.coords, offsets=self.offsets, depth=self.depth, circles=self.circles,
+                 modifiers=self.modifiers, **extra)
+
+    @classmethod
+    def load(cls, file_name):
+        """Read a toolpath written by save()"""
+        with np.load(file_name) as data:
+            return cls.from_arrays(data)
+
+    @classmethod
+    def from_arrays(cls, data):
+        """Make a toolpath from a mapping with the arrays written by save()"""
+        return cls(data["coords"], data["offsets"], data["depth"], data["circles"], data["modifiers"])
+
+@profiled(vertices=lambda toolpath, *args, **kwargs: len(toolpath.coords))
+def emit_toolpath(toolpath, gcode_writer, settings):
+    """
+    Turn a toolpath into gcode. The same toolpath can be emitted again with other flow and speed
+    settings without making the arcs again.
+
+    Parameters
+    ----------
+    toolpath: Toolpath
+
+    gcode_writer: GcodeWriter
+        Where the gcode is written
+
+    settings: dict
+        line_width, layer_height, filament_diameter, e_multiplier, feedrate: print settings
+        gcode_arcs (optional): print the arcs with G2/G3 moves instead of many short straight moves
+        retract_min_travel (optional): don't retract for travels between paths shorter than this (mm)
+    """
+    if len(toolpath) == 0:
+        return
+    coords, offsets = toolpath.coords, toolpath.offsets
+    starts = offsets[:-1]
+    path_index = np.repeat(np.arange(len(toolpath)), np.diff(offsets))
+    speed_modifiers, e_modifiers = MODIFIERS[toolpath.modifiers].T
+    feedrate = (settings["feedrate"] * speed_modifiers)[path_index]
+    short_travel = short_travels(toolpath, settings.get("retract_min_travel", 0))
+
+    e_distances = move_extrusion(coords, starts, settings["line_width"], settings["layer_height"],
+                                 settings["filament_diameter"], (settings["e_multiplier"] * e_modifiers)[path_index])
+
+    offsets_ij = clockwise = None
+    if settings.get("gcode_arcs"):
+        # Merge the moves along the circle of every arc, one arc at a time
+        merged = []
+        for i, circle in enumerate(toolpath.circles):
+            start, end = offsets[i], offsets[i + 1]
+            if np.isnan(circle[2]):
+                merged.append((coords[start:end], e_distances[start:end], np.full((end - start, 2), np.nan),
+                               np.zeros(end - start, dtype=bool), feedrate[start:end], short_travel[start:end]))
             else:
-                feedrate = feedrate_printing
+                path = merge_circle_moves(coords[start:end], e_distances[start:end], tuple(circle))
+                # The first move of a path always stays a move of its own
+                path_short_travel = np.zeros(len(path[0]), dtype=bool)
+                path_short_travel[0] = short_travel[start]
+                merged.append((*path, np.full(len(path[0]), feedrate[start]), path_short_travel))
+        coords, e_distances, offsets_ij, clockwise, feedrate, short_travel = (np.concatenate(column)
+                                                                              for column in zip(*merged))
 
-            gcode_file.write(f"G0 "
-                            f"X{'{0:.3f}'.format(coordinate[0])} "
-                            f"Y{'{0:.3f}'.format(coordinate[1])} "
-                            f"E{'{0:.8f}'.format(e_distance)} "
-                            f"F{feedrate*60}\n")
+    # Travels between paths that are short don't get a retraction
+    write_extruded_moves(gcode_writer, coords, e_distances, feedrate, short_travel, offsets_ij, clockwise)
 
-            if e_distance <= 0.000001:
-                feedrate = feedrate_travel
-                gcode_file.write("G1 E1 F1500\n") # deretract
+def short_travels(toolpath, min_travel):
+    """
+    The first moves of the paths of a toolpath that travel less than min_travel from where the
+    previous path ended, as a bool array over all points. The first path never counts as short.
+    """
+    short = np.zeros(len(toolpath.coords), dtype=bool)
+    if min_travel > 0 and len(toolpath) > 1:
+        starts = toolpath.offsets[1:-1]
+        gaps = toolpath.coords[starts] - toolpath.coords[starts - 1]
+        short[starts] = np.sqrt(gaps[:, 0]*gaps[:, 0] + gaps[:, 1]*gaps[:, 1]) < min_travel
+    return short
 
-            prev_coordinate = coordinate
-    return
+# Time for a retraction and the deretraction after it: 1 mm each way at F1500
+RETRACT_SECONDS = 2 * 1 / (1500 / 60)
+
+def estimate_print_time(toolpath, settings):
+    """
+    Rough print time of a toolpath, from the length of its moves at the feedrates emit_toolpath
+    would use, plus RETRACT_SECONDS for every retraction. Ignores acceleration.
+
+    Returns
+    -------
+    dict
+        seconds, travel (mm between paths), number of retractions
+    """
+    if len(toolpath) == 0:
+        return {"seconds": 0.0, "travel": 0.0, "retractions": 0}
+    coords, offsets = toolpath.coords, toolpath.offsets
+    path_index = np.repeat(np.arange(len(toolpath)), np.diff(offsets))
+    feedrate = (settings["feedrate"] * MODIFIERS[toolpath.modifiers][:, 0])[path_index]
+    deltas = np.diff(coords, axis=0, prepend=coords[:1])
+    distances = np.sqrt(deltas[:, 0]*deltas[:, 0] + deltas[:, 1]*deltas[:, 1])
+    travel = np.zeros(len(coords), dtype=bool)
+    travel[offsets[:-1]] = True
+    retractions = int(np.sum(travel & ~short_travels(toolpath, settings.get("retract_min_travel", 0))))
+    seconds = (np.sum(distances[~travel] / feedrate[~travel]) + np.sum(distances[travel] / (feedrate[travel] * 20))
+               + retractions * RETRACT_SECONDS)
+    return {"seconds": float(seconds), "travel": float(np.sum(distances[travel])), "retractions": retractions}
+
+def toolpath_branches(toolpath):
+    """
+    The branches of a toolpath: runs of arcs cut from circles with the same center.
+
+    Returns
+    -------
+    list of (int, int)
+        Index of the first path of every branch and of the path after its last one
+    """
+    circles = toolpath.circles
+    is_arc = ~np.isnan(circles[:, 2])
+    new_run = np.ones(len(circles), dtype=bool)
+    new_run[1:] = np.any(circles[1:, :2] != circles[:-1, :2], axis=1) | (is_arc[1:] != is_arc[:-1])
+    run_starts = np.nonzero(new_run)[0]
+    run_ends = np.append(run_starts[1:], len(circles))
+    return [(int(start), int(end)) for start, end in zip(run_starts, run_ends) if is_arc[start]]
+
+@profiled(vertices=lambda toolpath, *args, **kwargs: len(toolpath.coords))
+def order_toolpath(toolpath, line_width):
+    """
+    Reorder the branches of a toolpath, and the direction of their arcs, to cut down on travel.
+
+    Every arc has to rest on material that is already printed. Arcs of a branch stay in order from
+    the inside out, and a branch is only printed once every branch printed before it in the original
+    order that it comes within 1.5 line widths of (its parent, and neighbours its arcs were cut against)
+    has been printed. Of the branches that are ready, the one closest to the nozzle goes next (greedy
+    nearest neighbour), and every arc is started from whichever of its ends is closer.
+    Other paths (the perimeter rings) stay at the end in their original order.
+
+    Parameters
+    ----------
+    toolpath: Toolpath
+        In the order util.arc_overhang made it
+
+    line_width: float
+
+    Returns
+    -------
+    Toolpath
+        The same paths in the new order, some of them reversed
+    """
+    branches = toolpath_branches(toolpath)
+    if not branches:
+        return toolpath
+
+    # Which earlier branches every branch touches
+    geometries = []
+    for start, end in branches:
+        paths = [toolpath.path(i) for i in range(start, end)]
+        geometries.append(GeometryCollection([LineString(path) if len(path) > 1 else Point(path[0]) for path in paths]))
+    tree = shapely.STRtree(geometries)
+    branch_index, other_index = tree.query(geometries, predicate='dwithin', distance=1.5*line_width)
+    earlier = other_index < branch_index
+    waiting = np.bincount(branch_index[earlier], minlength=len(branches))
+    dependents = [[] for _ in branches]
+    for branch, other in zip(branch_index[earlier], other_index[earlier]):
+        dependents[other].append(branch)
+
+    first_paths = [toolpath.path(start) for start, _ in branches]
+    first_ends = np.array([[path[0], path[-1]] for path in first_paths])
+    position = first_paths[0][0]
+    ready = [i for i in range(len(branches)) if waiting[i] == 0]
+    order = []
+    while ready:
+        # Closest end of the first arc of every ready branch
+        candidates = np.array(ready)
+        gaps = first_ends[candidates] - position
+        distances = np.min(np.sqrt(gaps[..., 0]*gaps[..., 0] + gaps[..., 1]*gaps[..., 1]), axis=1)
+        branch = int(candidates[np.argmin(distances)])
+        ready.remove(branch)
+        start, end = branches[branch]
+        for i in range(start, end):
+            path = toolpath.path(i)
+            reverse = math.dist(position, path[-1]) < math.dist(position, path[0])
+            order.append((i, reverse))
+            position = path[0] if reverse else path[-1]
+        for other in dependents[branch]:
+            waiting[other] -= 1
+            if waiting[other] == 0:
+                ready.append(other)
+
+    in_branch = np.zeros(len(toolpath), dtype=bool)
+    for start, end in branches:
+        in_branch[start:end] = True
+    order += [(i, False) for i in range(len(toolpath)) if not in_branch[i]]
+
+    paths = [toolpath.path(i)[::-1] if reverse else toolpath.path(i) for i, reverse in order]
+    indexes = [i for i, _ in order]
+    return Toolpath(np.concatenate(paths), np.append(0, np.cumsum([len(path) for path in paths])),
+                    toolpath.depth[indexes], toolpath.circles[indexes], toolpath.modifiers[indexes])
+
+class Preview:
+    """
+    Collects the geometry that makes up the preview picture while the arcs are generated,
+    and draws it all at once at the end. Pass None instead of a Preview to skip plotting entirely.
+    """
+    def __init__(self):
+        self.base_polys = []
+        self.starting_lines = []
+        self.arcs = []
+        self.arc_depths = []
+        self.rings = []
+
+    def add_base_poly(self, poly):
+        self.base_polys.append(poly)
+
+    def add_starting_line(self, line):
+        self.starting_lines.append(line)
+
+    def add_arc(self, arc, depth):
+        self.arcs.append(arc)
+        self.arc_depths.append(depth)
+
+    def add_ring(self, line):
+        self.rings.append(line)
+
+    def extend(self, other):
+        """Add everything collected by another Preview (e.g. one filled in a worker process)"""
+        self.base_polys += other.base_polys
+        self.starting_lines += other.starting_lines
+        self.arcs += other.arcs
+        self.arc_depths += other.arc_depths
+        self.rings += other.rings
+
+    def render(self, file_name=None, dpi=600, show=False):
+        """
+        Plot everything collected so far
+
+        Parameters
+        ----------
+        file_name: str, optional
+            Save the picture here
+
+        dpi: int
+            Resolution of the saved picture
+
+        show: bool
+            Open a window with the picture
+
+        Returns
+        -------
+        fig: matplotlib Figure
+        """
+        # Plotting packages are slow to import, so only load them when a preview is actually drawn
+        import geopandas as gpd
+        import matplotlib.pyplot as plt
+
+        # Create a figure that we can plot stuff onto
+        fig, ax = plt.subplots(1, 2)
+        ax[0].set_aspect('equal')
+        ax[1].set_aspect('equal')
+        ax[0].title.set_text('Gcode Preview')
+        ax[1].title.set_text('Rainbow Visualization')
+
+        # Each group of shapes is plotted with a single call
+        if self.base_polys:
+            base_poly_geoseries = gpd.GeoSeries(self.base_polys)
+            base_poly_geoseries.plot(ax=ax[0], color='white', edgecolor='black', linewidth=1)
+            base_poly_geoseries.plot(ax=ax[1], color='white', edgecolor='black', linewidth=1)
+
+        if self.starting_lines:
+            gpd.GeoSeries(self.starting_lines).plot(ax=ax[0], color='red', linewidth=2)
+
+        if self.arcs:
+            arc_geoseries = gpd.GeoSeries(self.arcs)
+            arc_geoseries.plot(ax=ax[0], color='none', edgecolor='black', linewidth=1) # set color='none' for black and white plotting
+            arc_geoseries.plot(ax=ax[1], color=[num_to_rgb(depth) for depth in self.arc_depths], edgecolor='black', linewidth=1)
+
+        if self.rings:
+            gpd.GeoSeries(self.rings).plot(ax=ax[0], color='blue', edgecolor = 'blue', linewidth=1)
+
+        if file_name:
+            fig.savefig(file_name, dpi=dpi)
+        if show:
+            plt.show()
+        return fig
 
 def num_to_rgb(val, max_val=10):
     i = (val * 255 / max_val)
@@ -408,7 +1641,7 @@ def num_to_rgb(val, max_val=10):
 
 def generate_polygon(center: Tuple[float, float], avg_radius: float,
                      irregularity: float, spikiness: float,
-                     num_vertices: int) -> List[Tuple[float, float]]:
+                     num_vertices: int, rng: random.Random = None) -> List[Tuple[float, float]]:
     """
     Start with the center of the polygon at center, then creates the
     polygon by sampling points on a circle around the center.
@@ -432,9 +1665,14 @@ def generate_polygon(center: Tuple[float, float], avg_radius: float,
             the circumference.
         num_vertices (int):
             the number of vertices of the polygon.
+        rng (random.Random, optional):
+            random number generator to use, e.g. random.Random(seed) for
+            a repeatable shape. Uses the global random state by default.
     Returns:
         List[Tuple[float, float]]: list of vertices, in CCW order.
     """
+    rng = rng or random
+
     # Parameter check
     if irregularity < 0 or irregularity > 1:
         raise ValueError("Irregularity must be between 0 and 1.")
@@ -443,13 +1681,13 @@ def generate_polygon(center: Tuple[float, float], avg_radius: float,
 
     irregularity *= 2 * math.pi / num_vertices
     spikiness *= avg_radius
-    angle_steps = random_angle_steps(num_vertices, irregularity)
+    angle_steps = random_angle_steps(num_vertices, irregularity, rng)
 
     # now generate the points
     points = []
-    angle = random.uniform(0, 2 * math.pi)
+    angle = rng.uniform(0, 2 * math.pi)
     for i in range(int(num_vertices)):
-        radius = clip(random.gauss(avg_radius, spikiness), 0, 2 * avg_radius)
+        radius = clip(rng.gauss(avg_radius, spikiness), 0, 2 * avg_radius)
         point = (center[0] + radius * math.cos(angle),
                  center[1] + radius * math.sin(angle))
         points.append(point)
@@ -457,7 +1695,7 @@ def generate_polygon(center: Tuple[float, float], avg_radius: float,
 
     return points
 
-def random_angle_steps(steps: int, irregularity: float) -> List[float]:
+def random_angle_steps(steps: int, irregularity: float, rng: random.Random = None) -> List[float]:
     """Generates the division of a circumference in random angles.
 
     Args:
@@ -465,16 +1703,20 @@ def random_angle_steps(steps: int, irregularity: float) -> List[float]:
             the number of angles to generate.
         irregularity (float):
             variance of the spacing of the angles between consecutive vertices.
+        rng (random.Random, optional):
+            random number generator to use. Uses the global random state by default.
     Returns:
         List[float]: the list of the random angles.
     """
+    rng = rng or random
+
     # generate n angle steps
     angles = []
     lower = (2 * math.pi / steps) - irregularity
     upper = (2 * math.pi / steps) + irregularity
     cumsum = 0
     for i in range(int(steps)):
-        angle = random.uniform(lower, upper)
+        angle = rng.uniform(lower, upper)
         angles.append(angle)
         cumsum += angle
 